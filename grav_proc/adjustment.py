@@ -0,0 +1,226 @@
+'''
+Adjustment of the network of relative gravity readings by least squares
+'''
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.sparse.linalg import splu
+from grav_proc.calculations import session_order
+
+# number of columns of the unit matrix solved at once for the errors
+COVARIANCE_BLOCK_SIZE = 256
+
+
+def network_sessions(raw_data, by_lines=False):
+    ''' Session numbers of readings: the groups of fit_by_meter_created
+
+    The session is -1 if some of the keys of the reading are missing.
+    '''
+    _, sessions, _, _, _ = session_order(raw_data, by_lines)
+    return sessions
+
+
+def network_datum(stations, sessions, anchor=None):
+    ''' Fixed station for every station: the anchor (the first station if None)
+    or the first station of the part of network without the anchor
+
+    Stations are connected by the sessions, so the parts of the network are
+    the connected components of the graph of stations and sessions.
+    '''
+
+    station_codes, station_names = pd.factorize(stations)
+    station_names = list(station_names)
+    if anchor is None:
+        anchor = station_names[0]
+    if anchor not in station_names:
+        raise KeyError(f'{anchor} not found in stations')
+
+    graph = sparse.coo_matrix(
+        (np.ones(len(station_codes)), (station_codes, sessions)),
+        shape=(len(station_names), sessions.max() + 1)
+    )
+    graph = sparse.bmat([[None, graph], [graph.T, None]])
+    _, components = csgraph.connected_components(graph, directed=False)
+    station_components = components[:len(station_names)]
+
+    fixed_stations = {station_components[station_names.index(anchor)]: anchor}
+    # the stations are in the order of readings, so the first one of the part is fixed
+    for station, component in zip(station_names, station_components):
+        if component not in fixed_stations:
+            print(f'WARNING: {station} is fixed, the stations are not tied with {anchor}')
+            fixed_stations[component] = station
+
+    return {
+        station: fixed_stations[component] for station, component in zip(station_names, station_components)
+    }
+
+
+def network_design(raw_data, sessions, fixed, max_degree=2, scale_meters=()):
+    ''' Sparse design matrix of the network and the names of its parameters
+
+    The reading of the meter with the scale factor (1 + k) is
+    (1 + k) * reading = gravity(station) + drift(session, time),
+    where the drift is the polynomial of max_degree - 1 degree of the time
+    since the start of session. Parameters are the gravities of not fixed
+    stations, the drift coefficients and the k of the scale_meters.
+    '''
+
+    rows_number = len(raw_data)
+    row_indices = np.arange(rows_number)
+    rows, columns, values, names = [], [], [], []
+
+    station_codes, station_names = pd.factorize(raw_data.station)
+    free_stations = [station not in fixed for station in station_names]
+    station_columns = np.cumsum(free_stations) - 1
+    observed = np.asarray(free_stations)[station_codes]
+    rows.append(row_indices[observed])
+    columns.append(station_columns[station_codes[observed]])
+    values.append(np.ones(observed.sum()))
+    names += [('station', station) for station, free in zip(station_names, free_stations) if free]
+
+    sessions_number = sessions.max() + 1
+    days = raw_data.date_days.to_numpy(dtype=float)
+    days = days - pd.Series(days).groupby(sessions).transform('min').to_numpy()
+    for degree in range(max_degree):
+        rows.append(row_indices)
+        columns.append(len(names) + sessions)
+        values.append(days**degree)
+        names += [(f'drift_{degree}', session) for session in range(sessions_number)]
+
+    gravity = raw_data.corr_grav.to_numpy(dtype=float)
+    meters = raw_data.instrument_serial_number.to_numpy()
+    # the mean of session is taken by the drift, so the scale is fitted to the differences
+    centered = gravity - pd.Series(gravity).groupby(sessions).transform('mean').to_numpy()
+    for meter in scale_meters:
+        meter_rows = row_indices[meters == meter]
+        rows.append(meter_rows)
+        columns.append(np.full(len(meter_rows), len(names)))
+        values.append(-centered[meter_rows])
+        names.append(('scale', meter))
+
+    design_matrix = sparse.csr_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+        shape=(rows_number, len(names))
+    )
+
+    return design_matrix, names
+
+
+def sparse_wls(design_matrix, observations, weights, error_columns):
+    ''' Weighted least squares by the sparse factorization of the normal matrix
+
+    Returns parameters, their standard errors for error_columns and the
+    residuals. The errors are taken from the diagonal of the inverse normal
+    matrix which is solved by blocks of columns.
+    '''
+
+    root_weights = np.sqrt(weights)
+    weighted_design = sparse.diags(root_weights) @ design_matrix
+    normal_matrix = (weighted_design.T @ weighted_design).tocsc()
+    try:
+        # the normal matrix is symmetric, so is the fill reducing ordering
+        factor = splu(
+            normal_matrix,
+            permc_spec='MMD_AT_PLUS_A',
+            diag_pivot_thresh=0,
+            options={'SymmetricMode': True}
+        )
+    except RuntimeError as error:
+        raise ValueError('The network can not be adjusted: normal matrix is singular') from error
+
+    params = factor.solve(weighted_design.T @ (root_weights * observations))
+    resid = observations - design_matrix @ params
+
+    dof = design_matrix.shape[0] - design_matrix.shape[1]
+    sigma2 = np.sum(weights * resid**2) / dof if dof > 0 else np.nan
+
+    error_columns = np.asarray(error_columns, dtype=int)
+    variances = np.empty(len(error_columns))
+    for start in range(0, len(error_columns), COVARIANCE_BLOCK_SIZE):
+        block = error_columns[start:start + COVARIANCE_BLOCK_SIZE]
+        unit = np.zeros((normal_matrix.shape[0], len(block)))
+        unit[block, np.arange(len(block))] = 1
+        variances[start:start + len(block)] = factor.solve(unit)[block, np.arange(len(block))]
+
+    return params, np.sqrt(sigma2 * variances), resid
+
+
+def network_adjustment(raw_data, anchor=None, max_degree=2, scale_factors=False, by_lines=False):
+    ''' Adjust readings of all meters and sessions together
+
+    raw_data is the frame of make_frame_to_proc. The gravities of stations
+    relative to the anchor (the first station if None), the drift of every
+    session (the groups of fit_by_meter_created) and, with scale_factors,
+    the scale factors of meters but the first one are the parameters. The
+    readings are weighted as in free_grav_fit.
+
+    Returns the ties from the anchor to the stations, the frame can be
+    passed to get_report and get_map, and the frame of scale factors of
+    meters. The residuals are stored to the resid column of raw_data.
+    The readings without session (some of its keys are missing) are left
+    out as in fit_by_meter_created, their residuals are NaN.
+    '''
+
+    sessions = network_sessions(raw_data, by_lines)
+    in_sessions = sessions >= 0
+    if not in_sessions.all():
+        print(f'WARNING: {np.sum(~in_sessions)} readings without session keys are not adjusted')
+    readings = raw_data[in_sessions]
+    sessions = sessions[in_sessions]
+    datum = network_datum(readings.station, sessions, anchor)
+
+    scale_meters = []
+    meters = sorted(readings.instrument_serial_number.unique())
+    if scale_factors:
+        # the scale of the first meter defines the scale of the network
+        scale_meters = meters[1:]
+
+    design_matrix, names = network_design(
+        readings, sessions, set(datum.values()), max_degree, scale_meters
+    )
+
+    error_columns = [
+        column for column, (kind, _) in enumerate(names) if kind in ('station', 'scale')
+    ]
+    params, errors, resid = sparse_wls(
+        design_matrix,
+        readings.corr_grav.to_numpy(dtype=float),
+        1 / readings.std_err.to_numpy(dtype=float),
+        error_columns
+    )
+    raw_data['resid'] = np.nan
+    raw_data.loc[in_sessions, 'resid'] = resid
+
+    adjusted = {names[column]: (params[column], error) for column, error in zip(error_columns, errors)}
+    stations = [station for kind, station in adjusted if kind == 'station']
+
+    ties = pd.DataFrame(
+        {
+            'station_from': [datum[station] for station in stations],
+            'station_to': stations,
+            'tie': [adjusted[('station', station)][0] for station in stations],
+            'err': [adjusted[('station', station)][1] for station in stations],
+        }
+    )
+
+    station_means = readings.groupby('station', observed=True)[['lat', 'lon', 'instr_height']].mean()
+    ties['instrument_serial_number'] = ', '.join(str(meter) for meter in meters)
+    ties['survey_name'] = ', '.join(str(survey) for survey in readings.survey_name.unique())
+    ties['operator'] = ', '.join(str(operator) for operator in readings.operator.unique())
+    ties['meter_type'] = ', '.join(str(meter_type) for meter_type in readings.meter_type.unique())
+    ties['date_time'] = readings.created.max().date()
+    for column in ['lat', 'lon', 'instr_height']:
+        ties[f'{column}_from'] = ties.station_from.map(station_means[column]).to_numpy(dtype=float)
+        ties[f'{column}_to'] = ties.station_to.map(station_means[column]).to_numpy(dtype=float)
+
+    scales = pd.DataFrame({'instrument_serial_number': meters})
+    scales['scale_factor'] = [
+        1 + adjusted[('scale', meter)][0] if ('scale', meter) in adjusted else 1.0 for meter in meters
+    ]
+    scales['scale_factor_std'] = [
+        adjusted[('scale', meter)][1] if ('scale', meter) in adjusted else 0.0 for meter in meters
+    ]
+
+    return ties, scales
@@ -0,0 +1,134 @@
+'''
+Opening of plain, compressed and archived data files
+'''
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+import re
+import zipfile
+
+
+class DataFile(io.TextIOWrapper):
+    ''' Text stream of data file which keeps the name of its source '''
+
+    def __init__(self, buffer, name):
+        super().__init__(buffer, encoding='utf-8')
+        self._source_name = name
+
+    @property
+    def name(self):
+        return self._source_name
+
+
+class ZstdReader(io.RawIOBase):
+    ''' Stream of decompressed zstd file, it can be rewinded to the start only '''
+
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+        self._open()
+
+    def _open(self):
+        try:
+            import zstandard
+        except ImportError as error:
+            raise ImportError(f'zstandard package is needed to read {self.name}') from error
+        self._file = open(self.name, 'rb')
+        self._reader = zstandard.ZstdDecompressor().stream_reader(
+            self._file,
+            read_across_frames=True
+        )
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._reader.read(len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR and offset == 0:
+            return self._position
+        if whence != io.SEEK_SET or offset != 0:
+            raise io.UnsupportedOperation('zstd stream can be rewinded to the start only')
+        self._reader.close()
+        self._file.close()
+        self._open()
+        return 0
+
+    def close(self):
+        if not self.closed:
+            self._reader.close()
+            self._file.close()
+        super().close()
+
+
+def open_zstd(name):
+    return io.BufferedReader(ZstdReader(name))
+
+
+COMPRESSED_OPENERS = {
+    '.gz': lambda name: gzip.open(name, 'rb'),
+    '.bz2': lambda name: bz2.open(name, 'rb'),
+    '.xz': lambda name: lzma.open(name, 'rb'),
+    '.zst': open_zstd,
+}
+
+
+def is_zip_archive(name):
+    return name.lower().endswith('.zip') and zipfile.is_zipfile(name)
+
+
+def zip_members(archive):
+    ''' Names of data files in the zip archive as archive.zip/member '''
+    with zipfile.ZipFile(archive) as zip_file:
+        return [
+            f'{archive}/{member.filename}' for member in zip_file.infolist() if not member.is_dir()
+        ]
+
+
+def split_archive_name(name):
+    ''' Split archive.zip/member name to (archive, member), (name, None) for other files '''
+    if os.path.exists(name):
+        return name, None
+    split_name = re.split(r'(?<=\.zip)[/\\]', name, maxsplit=1, flags=re.IGNORECASE)
+    if len(split_name) == 2 and os.path.isfile(split_name[0]):
+        return split_name[0], split_name[1]
+    return name, None
+
+
+def open_binary(name):
+    ''' Open data file as decompressed binary stream
+
+    The name is a path of plain or compressed (.gz, .bz2, .xz, .zst) file or
+    archive.zip/member for the file in zip archive.
+    '''
+
+    archive, member = split_archive_name(name)
+    if member is not None:
+        # the member stays readable after the archive is closed
+        with zipfile.ZipFile(archive) as zip_file:
+            return zip_file.open(member)
+
+    extension = os.path.splitext(name)[1].lower()
+    if extension in COMPRESSED_OPENERS:
+        return COMPRESSED_OPENERS[extension](name)
+
+    return open(name, 'rb')
+
+
+def open_data_file(name):
+    ''' Open data file (see open_binary) as text stream, it is decompressed while reading '''
+    return DataFile(open_binary(name), name)
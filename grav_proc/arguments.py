@@ -28,7 +28,7 @@ def cli_rgrav_arguments():
     parser.add_argument(
         '--input',
         nargs='+',
-        help='Input data files'
+        help='Input data files, also compressed (.gz, .bz2, .xz, .zst) and zip archives'
     )
 
     parser.add_argument(
@@ -75,6 +75,77 @@ def cli_rgrav_arguments():
         help='Fix Station'
     )
 
+    parser.add_argument(
+        '--network',
+        action='store_true',
+        help='Adjust readings of all meters and sessions as one network'
+    )
+
+    parser.add_argument(
+        '--fit_scale_factors',
+        action='store_true',
+        help='Fit scale factors of meters (relative to the first one) in the network adjustment'
+    )
+
+    parser.add_argument(
+        '--max_degree',
+        type=int,
+        default=2,
+        help='Number of terms of the drift polynomial of sessions (default 2: linear drift)'
+    )
+
+    parser.add_argument(
+        '--drift_criterion',
+        choices=['aic', 'bic'],
+        help='Choose the number of terms of drift (1 to max_degree) of every session by the criterion'
+    )
+
+    parser.add_argument(
+        '--state_dir',
+        type=str,
+        help='Directory of the fit states of sessions: only the readings appended since the last run are fitted (WLS)'
+    )
+
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help='Number of processes to read data files and fit the ties (default 1)'
+    )
+
+    parser.add_argument(
+        '--no_cache',
+        action='store_true',
+        help='Do not use the cache of parsed data files and fits'
+    )
+
+    parser.add_argument(
+        '--lines',
+        type=int,
+        nargs='+',
+        help='Process the readings of the lines only'
+    )
+
+    parser.add_argument(
+        '--stations',
+        nargs='+',
+        help='Process the readings on the stations only'
+    )
+
+    parser.add_argument(
+        '--meters',
+        type=int,
+        nargs='+',
+        help='Process the readings of the meters (serial numbers) only'
+    )
+
+    parser.add_argument(
+        '--time_range',
+        nargs=2,
+        metavar=('START', 'END'),
+        help='Process the readings in the time range only (e.g. 2023-04-05T08:00 2023-04-05T18:00)'
+    )
+
     return parser.parse_args()
 
 def gui_rgrav_arguments():
@@ -87,7 +158,11 @@ def gui_rgrav_arguments():
     
     data_file_names = fd.askopenfilenames(
         defaultextension='.dat',
-        filetypes=[('CG-6 data files', '*.dat'), ('All files', '*')],
+        filetypes=[
+            ('CG-6 data files', '*.dat'),
+            ('Compressed data files', '*.gz *.bz2 *.xz *.zst *.zip'),
+            ('All files', '*')
+        ],
         title='Choose data file'
     )
     
@@ -129,9 +204,20 @@ def gui_rgrav_arguments():
         arguments.append('--by_lines')
 
     parser.add_argument('--anchor', type=str)
+    parser.add_argument('--network', action='store_true')
+    parser.add_argument('--fit_scale_factors', action='store_true')
+    parser.add_argument('--max_degree', type=int, default=2)
+    parser.add_argument('--drift_criterion')
+    parser.add_argument('--state_dir', type=str)
     parser.add_argument('--plot', action='store_true')
     parser.add_argument('--map', action='store_true')
     parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--no_cache', action='store_true')
+    parser.add_argument('--lines', type=int, nargs='+')
+    parser.add_argument('--stations', nargs='+')
+    parser.add_argument('--meters', type=int, nargs='+')
+    parser.add_argument('--time_range', nargs=2)
 
     return parser.parse_args(arguments)
     
@@ -148,7 +234,7 @@ def cli_vgrad_arguments():
     parser.add_argument(
         '--input',
         nargs='+',
-        help='Input data files'
+        help='Input data files, also compressed (.gz, .bz2, .xz, .zst) and zip archives'
     )
 
     parser.add_argument(
@@ -184,6 +270,52 @@ def cli_vgrad_arguments():
         help='Calibration factors for all gravimeters'
     )
 
+    parser.add_argument(
+        '--drift_criterion',
+        choices=['aic', 'bic'],
+        help='Choose the degree of drift (0 to 2) of every line by the criterion'
+    )
+
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help='Number of processes to read data files (default 1)'
+    )
+
+    parser.add_argument(
+        '--no_cache',
+        action='store_true',
+        help='Do not use the cache of parsed data files'
+    )
+
+    parser.add_argument(
+        '--lines',
+        type=int,
+        nargs='+',
+        help='Process the readings of the lines only'
+    )
+
+    parser.add_argument(
+        '--stations',
+        nargs='+',
+        help='Process the readings on the stations only'
+    )
+
+    parser.add_argument(
+        '--meters',
+        type=int,
+        nargs='+',
+        help='Process the readings of the meters (serial numbers) only'
+    )
+
+    parser.add_argument(
+        '--time_range',
+        nargs=2,
+        metavar=('START', 'END'),
+        help='Process the readings in the time range only (e.g. 2023-04-05T08:00 2023-04-05T18:00)'
+    )
+
     return parser.parse_args()
 
 
@@ -191,7 +323,11 @@ def gui_vgrad_arguments():
     
     data_file_names = fd.askopenfilenames(
         defaultextension='.dat',
-        filetypes=[('CG-6 data files', '*.dat'), ('All files', '*')],
+        filetypes=[
+            ('CG-6 data files', '*.dat'),
+            ('Compressed data files', '*.gz *.bz2 *.xz *.zst *.zip'),
+            ('All files', '*')
+        ],
         title='Choose data file'
     )
     
@@ -258,5 +394,13 @@ def gui_vgrad_arguments():
         arguments.append('--scale_factors')
         arguments.append(scale_factors)
 
+    parser.add_argument('--drift_criterion')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--no_cache', action='store_true')
+    parser.add_argument('--lines', type=int, nargs='+')
+    parser.add_argument('--stations', nargs='+')
+    parser.add_argument('--meters', type=int, nargs='+')
+    parser.add_argument('--time_range', nargs=2)
+
     return parser.parse_args(arguments)
  
\ No newline at end of file
@@ -0,0 +1,81 @@
+'''
+On-disk cache of parsed data files
+'''
+
+import hashlib
+import os
+import pandas as pd
+from grav_proc.archives import open_binary
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+    'grav_proc'
+)
+
+DEFAULT_CACHE_SIZE = 512 * 2**20 # bytes
+
+CACHE_SUFFIX = '.parquet'
+
+
+def cache_available():
+    ''' Parquet engine is needed to store the parsed frames '''
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+
+def cache_key(data_file_name, parser):
+    ''' Key of the parsed file: parser name and version, hash of decompressed file content '''
+    content_hash = hashlib.sha256()
+    with open_binary(data_file_name) as data_file:
+        for chunk in iter(lambda: data_file.read(2**20), b''):
+            content_hash.update(chunk)
+    return f'{parser}-{content_hash.hexdigest()}'
+
+
+def load_cached(cache_dir, key):
+    ''' Get parsed frame from the cache or None '''
+    path = os.path.join(cache_dir, key + CACHE_SUFFIX)
+    try:
+        frame = pd.read_parquet(path)
+    except (OSError, ValueError):
+        return None
+    # the last access time is the order of eviction
+    os.utime(path)
+    return frame
+
+
+def store_cached(cache_dir, key, frame, max_size=DEFAULT_CACHE_SIZE):
+    ''' Put parsed frame to the cache and evict the least recently used files '''
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key + CACHE_SUFFIX)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        frame.to_parquet(temp_path, index=False)
+        os.replace(temp_path, path)
+    except (OSError, ValueError, TypeError):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return
+    evict_cached(cache_dir, max_size)
+
+
+def evict_cached(cache_dir, max_size=DEFAULT_CACHE_SIZE, suffix=CACHE_SUFFIX):
+    ''' Remove the least recently used files of suffix while the cache is bigger than max_size '''
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(suffix):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort()
+    cache_size = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if cache_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        cache_size -= size
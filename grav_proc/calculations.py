@@ -1,32 +1,150 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
 import pandas as pd
-from datetime import datetime as dt
 # from time import time as tm
 import numpy as np
 import networkx as nx
 import statsmodels.api as sm
+from grav_proc.fit_cache import anchored_fit, fit_entry, fit_key, load_fit, store_fits
+from grav_proc.least_squares import best_terms, check_criterion, lstsq_fits, nested_lstsq, robust_fits, station_design
+from grav_proc.shared import attach_columns, read_column, share_columns
+
+# columns of read_data frame which are used by make_frame_to_proc
+COLUMNS_TO_PROC = [
+    'date_time',
+    'date_days',
+    'Created',
+    'Survey Name',
+    'Operator',
+    'Instrument Serial Number',
+    'InstrHeight',
+    'Line',
+    'Station',
+    'CorrGrav',
+    'StdErr',
+    'DataFile',
+    'LatUser',
+    'LonUser',
+    'LatGPS',
+    'LonGPS',
+    'MeterType',
+]
+
+# text columns of read_data frame which are categorical in the reduced chunks
+CHUNK_CATEGORICAL_COLUMNS = ['Survey Name', 'Operator', 'Station', 'DataFile', 'MeterType']
+
+# max std of the coordinates of station readings by one meter, degrees
+COORDS_STD_THRESHOLD = 0.001
+
+# max number of independent cycles of the ties graph to find all its cycles
+EXHAUSTIVE_CYCLES_LIMIT = 12
+
+
+def replace_coordinate(user, gps):
+    ''' Column of GPS coordinates where they are ('--' or None if not), user ones otherwise '''
+    gps = pd.to_numeric(pd.Series(gps).replace('--', None), errors='coerce')
+    user = pd.to_numeric(pd.Series(user).replace('--', None), errors='coerce')
+    return gps.fillna(user).astype(float)
+
+
+def reading_coordinates(data):
+    ''' Frame of lat and lon of every reading of read_data frame (see replace_coordinate) '''
+    return pd.DataFrame(
+        {
+            'lat': replace_coordinate(data['LatUser'], data['LatGPS']).to_numpy(),
+            'lon': replace_coordinate(data['LonUser'], data['LonGPS']).to_numpy(),
+        },
+        index=data.index
+    )
 
 
-def replace_lat(lat_user, lat_gps):
-    if lat_gps == '--':
-        result = lat_user
-    else:
-        result = lat_gps
-    return float(result)
+def reduce_chunk(chunk):
+    ''' Chunk of read_data reduced to what make_frame_to_proc needs
+
+    The four coordinate columns are replaced by the lat and lon of readings
+    and the text columns are categorical.
+    '''
+    chunk = chunk[COLUMNS_TO_PROC]
+    coords = reading_coordinates(chunk)
+    chunk = chunk.drop(columns=['LatUser', 'LonUser', 'LatGPS', 'LonGPS'])
+    chunk[['lat', 'lon']] = coords
+    for column in CHUNK_CATEGORICAL_COLUMNS:
+        chunk[column] = chunk[column].astype('category')
+    return chunk
+
+
+def concat_chunks(chunks):
+    ''' Concatenate the reduced chunks, categorical columns by the union of their categories '''
+    chunks = list(chunks) or [reduce_chunk(pd.DataFrame(columns=COLUMNS_TO_PROC))]
+    data = pd.concat([chunk.drop(columns=CHUNK_CATEGORICAL_COLUMNS) for chunk in chunks])
+    for column in CHUNK_CATEGORICAL_COLUMNS:
+        data[column] = pd.Categorical(
+            pd.api.types.union_categoricals([chunk[column] for chunk in chunks])
+        )
+    return data
 
-def replace_lon(lon_user, lon_gps):
-    if lon_gps == '--':
-        result = lon_user
-    else:
-        result = lon_gps
-    return float(result)
 
+def station_registry(*frames):
+    ''' Registry of the stations of processing frames
+
+    It is a categorical dtype: code of the station is the position of its
+    name in the categories. Frames compacted with the same registry share
+    the station codes.
+    '''
+    names = pd.concat([frame.station.astype(str) for frame in frames]).unique()
+    return pd.CategoricalDtype(sorted(names))
+
+
+def compact_frame(data, registry=None):
+    ''' Keep the repeated text columns of processing frame as integer codes (categorical) '''
+    stations = data['station'].astype(str)
+    if registry is None:
+        registry = station_registry(data)
+    # casting would turn the stations out of the registry into NaN
+    unknown = set(stations) - set(registry.categories)
+    if unknown:
+        raise ValueError(f'Stations are not in the registry: {", ".join(sorted(unknown))}')
+    data = data.copy()
+    data['station'] = stations.astype(registry)
+    for column in ['survey_name', 'operator', 'data_file', 'meter_type']:
+        data[column] = data[column].astype('category')
+    return data
+
+
+def coords_spread_table(group_by_meter_station, threshold=COORDS_STD_THRESHOLD):
+    ''' Table of meters and stations with std of coordinates more than threshold '''
+    coords_spread = group_by_meter_station.agg(['mean', 'std', 'size'])
+    coords_spread.columns = ['lat', 'lat_std', 'count', 'lon', 'lon_std', 'lon_count']
+    coords_spread = coords_spread[
+        (coords_spread.lat_std > threshold) | (coords_spread.lon_std > threshold)
+    ]
+    coords_spread = coords_spread.reset_index()[
+        ['Instrument Serial Number', 'Station', 'count', 'lat', 'lon', 'lat_std', 'lon_std']
+    ]
+    coords_spread.columns = [
+        'instrument_serial_number', 'station', 'count', 'lat', 'lon', 'lat_std', 'lon_std'
+    ]
+    return coords_spread
 
-def make_frame_to_proc(cg_data):
-    ''' Make a data frame to processing (only needed columns to be selected) '''
+
+def make_frame_to_proc(cg_data, compact=False, registry=None, spread=False):
+    ''' Make a data frame to processing (only needed columns to be selected)
+
+    cg_data is a frame of read_data or an iterable of its chunks (see
+    iter_data_chunks), in the latter case every chunk is reduced to the
+    coordinates of readings and the codes of its text columns (see
+    reduce_chunk) before it is kept. With compact the text columns are
+    categorical, stations are coded by registry (see station_registry).
+
+    Coordinates of the station are the means of its readings by the meter.
+    The stations with std of coordinates more than COORDS_STD_THRESHOLD are
+    printed, with spread the table of them is returned with the frame.
+    '''
 
 
     headers = [
         'date_time',
+        'date_days',
         'created',
         'survey_name',
         'operator',
@@ -42,35 +160,34 @@ def make_frame_to_proc(cg_data):
         'meter_type',
     ]
 
-    data = cg_data
+    if isinstance(cg_data, pd.DataFrame):
+        data = cg_data
+        coords = reading_coordinates(data)
+    else:
+        data = concat_chunks(reduce_chunk(chunk) for chunk in cg_data)
+        coords = data[['lat', 'lon']].copy()
 
     data['CorrGrav'] = data['CorrGrav'] * 1e3
     data['StdErr']  = data['StdErr'] * 1e3
     data['InstrHeight'] = data['InstrHeight'] * 1e3
 
-    group_by_meter_station = data.groupby(['Instrument Serial Number', 'Station'])
-    for meter_station, grouped_by_meter_station in group_by_meter_station:
-        meter, station = meter_station
-        indices = grouped_by_meter_station.index
-
-        grouped_by_meter_station['LatGPS'] = grouped_by_meter_station.apply(lambda x: replace_lat(x['LatUser'], x['LatGPS']), axis=1)
-        grouped_by_meter_station['LonGPS'] = grouped_by_meter_station.apply(lambda x: replace_lat(x['LonUser'], x['LonGPS']), axis=1)
-        
-        lat = grouped_by_meter_station['LatGPS'].mean()
-        lat_std = grouped_by_meter_station['LatGPS'].std()
-        lon = grouped_by_meter_station['LonGPS'].mean()
-        lon_std = grouped_by_meter_station['LonGPS'].std()
+    group_by_meter_station = coords.groupby(
+        [data['Instrument Serial Number'], data['Station']],
+        observed=True
+    )
+    data[['lat', 'lon']] = group_by_meter_station.transform('mean')
 
-        if lat_std > 0.001 or lon_std > 0.001:
-            print(f'WARNING: {meter} {station}')
-            print('    lat_std = ', lat_std, ', lon_std = ', lon_std)
+    coords_spread = coords_spread_table(group_by_meter_station)
+    if not isinstance(cg_data, pd.DataFrame):
+        coords_spread['station'] = coords_spread.station.astype(data['Station'].cat.categories.dtype)
+    if not spread and len(coords_spread):
+        print(f'WARNING: std of coordinates of stations is more than {COORDS_STD_THRESHOLD}')
+        print(coords_spread.to_string(index=False))
 
-        data.loc[indices, 'lat'] = lat
-        data.loc[indices, 'lon'] = lon
-    
     data = data[
         [
             'date_time',
+            'date_days',
             'Created',
             'Survey Name',
             'Operator',
@@ -89,108 +206,104 @@ def make_frame_to_proc(cg_data):
 
     data.columns = headers
 
+    if not isinstance(cg_data, pd.DataFrame):
+        # the codes of chunks are text again as in the frame of read_data
+        for column in ['survey_name', 'operator', 'station', 'data_file', 'meter_type']:
+            data[column] = data[column].astype(data[column].cat.categories.dtype)
+
+    if compact:
+        data = compact_frame(data, registry)
+
+    if spread:
+        return data, coords_spread
+
     return data
 
 
+def apply_scale_factors(frame, factors):
+    ''' Multiply corr_grav of readings by the scale factors of their meters
+
+    factors is the frame of read_scale_factors, the first factor of the
+    meter is used if there are more. The scale_factor and scale_factor_std
+    columns are added to the frame (NaN for the meters without factors,
+    their readings are not changed). Returns the frame.
+    '''
+
+    duplicated = factors.instrument_serial_number.duplicated()
+    for meter in factors.instrument_serial_number[duplicated].unique():
+        print(f'WARNING: There is more than one scale factor for the meter {meter}, the first one is used')
+
+    factors = factors.loc[~duplicated, ['instrument_serial_number', 'scale_factor', 'scale_factor_std']]
+    joined = frame[['instrument_serial_number']].join(
+        factors.set_index('instrument_serial_number'), on='instrument_serial_number'
+    )
+    frame['scale_factor'] = joined.scale_factor.to_numpy(dtype=float)
+    frame['scale_factor_std'] = joined.scale_factor_std.to_numpy(dtype=float)
+    frame['corr_grav'] = frame.corr_grav.to_numpy(dtype=float) * np.nan_to_num(frame.scale_factor.to_numpy(), nan=1.0)
+
+    return frame
+
+
 def get_meters_readings(cg_data):
     ''' Get mean values of signals of readings from different meters '''
 
-    readings = pd.DataFrame()
-    group_by_meters = cg_data.groupby('instrument_serial_number')
-    for meter, meter_data in group_by_meters:
-        meter_readings = get_readings(meter_data)
-        readings = pd.concat([readings, meter_readings])
+    readings = setup_readings(cg_data, ['instrument_serial_number'])
+    # the readings of every meter are numbered from zero
+    readings.index = readings.groupby('instrument_serial_number', observed=True).cumcount().to_numpy()
     return readings
 
 
 def get_readings(cg_data):
     ''' Get mean values of signals of readings '''
+    return setup_readings(cg_data, [])
+
+
+def setup_readings(cg_data, keys):
+    ''' Mean values of signals of the setups (runs of readings on one station)
+
+    Readings are grouped by keys and line in the order of the frame, a setup
+    ends where the station changes. The signals of the last reading of the
+    setup are taken for the text columns, time is the middle of the setup.
+    Coordinates are the means of the setups on the station (for every keys).
+    '''
+
+    keys = keys + ['line']
+    data = cg_data.dropna(subset=keys).sort_values(keys, kind='stable')
+
+    # run-length segmentation: a setup starts where the keys or the station change
+    run_keys = data[keys + ['station']]
+    setup = np.cumsum((run_keys != run_keys.shift()).any(axis=1).to_numpy())
+    setup_starts = np.flatnonzero(np.diff(setup, prepend=0))
+    setup_ends = np.append(setup_starts[1:], len(data)) - 1
+
+    group_by_setup = data.groupby(setup, sort=False)
+    means = group_by_setup[['instr_height', 'corr_grav', 'lat_user', 'lon_user']].mean()
+
+    first_date_time = data.date_time.to_numpy()[setup_starts]
+    last_date_time = data.date_time.to_numpy()[setup_ends]
+    last_readings = data.iloc[setup_ends].reset_index(drop=True)
 
     readings = pd.DataFrame(
-        columns=[
-            'date_time',
-            'created',
-            'survey_name',
-            'operator',
-            'instrument_serial_number',
-            'instr_height',
-            'line',
-            'station',
-            'corr_grav',
-            'std_err',
-            'data_file',
-            'lat_user',
-            'lon_user',
-            'meter_type',
-        ]
+        {
+            'date_time': first_date_time + (last_date_time - first_date_time) / 2,
+            'created': last_readings.created,
+            'survey_name': last_readings.survey_name,
+            'operator': last_readings.operator,
+            'instrument_serial_number': last_readings.instrument_serial_number,
+            'instr_height': means.instr_height.to_numpy(),
+            'line': last_readings.line,
+            'station': last_readings.station,
+            'corr_grav': means.corr_grav.to_numpy(),
+            'std_err': group_by_setup.corr_grav.sem().to_numpy(),
+            'data_file': last_readings.data_file,
+            'lat_user': means.lat_user.to_numpy(),
+            'lon_user': means.lon_user.to_numpy(),
+            'meter_type': last_readings.meter_type,
+        }
     )
-    # readings['date_time'].to_datetime
-    reading_index = 0
-    group_by_line = cg_data.groupby('line')
-    for line, line_data in group_by_line:
-        trigger = False
-        count = 0
-        first_date_time = line_data.iloc[0].date_time
-        first_index = line_data.iloc[0].index
-        for index, row in line_data.iterrows():
-            if index == line_data.index[-1]:
-                readings.loc[reading_index] = [
-                    first_date_time + (row.date_time - first_date_time) / 2,
-                    row.created,
-                    row.survey_name,
-                    row.operator,
-                    row.instrument_serial_number,
-                    line_data.loc[first_index:index].instr_height.mean(),
-                    row.line,
-                    row.station,
-                    # line_data.loc[first_index:index].apply(lambda x: weighted_avg_and_std(x.corr_grav, x.std_err**-2)[0], axis=1),
-                    line_data.loc[first_index:index].corr_grav.mean(),
-                    # line_data.loc[first_index:index].apply(lambda x: weighted_avg_and_std(x.corr_grav, x.std_err**-2)[1], axis=1),
-                    line_data.loc[first_index:index].corr_grav.sem(),
-
-                    row.data_file,
-                    line_data.loc[first_index:index].lat_user.mean(),
-                    line_data.loc[first_index:index].lon_user.mean(),
-                    row.meter_type
-                ]
-                reading_index += 1
-                break
-            if row.station == line_data.station.iloc[count + 1]:
-                count += 1
-                if not trigger:
-                    trigger = True
-                    first_date_time = row.date_time
-                    first_index = index
-            else:
-                trigger = False
-                readings.loc[reading_index] = [
-                    first_date_time + (row.date_time - first_date_time) / 2,
-                    row.created,
-                    row.survey_name,
-                    row.operator,
-                    row.instrument_serial_number,
-                    line_data.loc[first_index:index].instr_height.mean(),
-                    row.line,
-                    row.station,
-                    # line_data.loc[first_index:index].apply(lambda x: weighted_avg_and_std(x.corr_grav, x.std_err**-2)[0], axis=1),
-                    line_data.loc[first_index:index].corr_grav.mean(),
-                    # line_data.loc[first_index:index].apply(lambda x: weighted_avg_and_std(x.corr_grav, x.std_err**-2)[1], axis=1),
-                    line_data.loc[first_index:index].corr_grav.sem(),
-                    row.data_file,
-                    line_data.loc[first_index:index].lat_user.mean(),
-                    line_data.loc[first_index:index].lon_user.mean(),
-                    row.meter_type
-                ]
-                count += 1
-                reading_index += 1
-
-    group_by_station = readings.groupby('station')
-    
-    for station, station_readings in group_by_station:
-        mean_lat = station_readings.lat_user.mean()
-        mean_lon = station_readings.lon_user.mean()
-        readings.loc[readings.station == station, 'lat_user'] = mean_lat
-        readings.loc[readings.station == station, 'lon_user'] = mean_lon
+
+    group_by_station = readings.groupby(keys[:-1] + ['station'], observed=True)
+    readings[['lat_user', 'lon_user']] = group_by_station[['lat_user', 'lon_user']].transform('mean')
 
     return readings
 
@@ -208,216 +321,199 @@ def weighted_avg_and_std(values, weights):
     variance = np.average((values-average)**2, weights=weights)
     return (average, np.sqrt(variance))
 
-def get_meters_ties(readings):
-    ''' Get ties from meters '''
-    ties = pd.DataFrame()
-    
-    group_by_meters = readings.groupby('instrument_serial_number')
-    
-    for meter, meter_readings in group_by_meters:
-        meter_ties = get_ties(meter_readings)
-        ties = pd.concat([ties, meter_ties])
-    
-    return ties
+def get_meters_ties(readings, jobs=1):
+    ''' Get ties from meters, meters are processed in process pool if jobs > 1 '''
+
+    meters_readings = [
+        meter_readings for _, meter_readings in readings.groupby('instrument_serial_number', observed=True)
+    ]
+
+    if jobs is None or jobs <= 1 or len(meters_readings) < 2:
+        meters_ties = [get_ties(meter_readings) for meter_readings in meters_readings]
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(meters_readings))) as executor:
+            meters_ties = list(executor.map(get_ties, meters_readings))
+
+    return pd.concat([pd.DataFrame()] + meters_ties)
+
+
+def loop_closures(stations, lines):
+    ''' Base and closing positions of the loops of readings
+
+    stations are the codes of stations (negative for unknown one) and lines
+    are the lines of readings in their order. A loop is closed by the reading
+    on the station of its base, then the next reading of the line becomes
+    the base. The readings between the base and the closing one are in the loop.
+
+    So the closing of a base is the first reading on its station after the
+    closing of the previous base of the line. This chain is solved with
+    array passes over all lines at once: every closing is moved to the first
+    reading on its station that is not before the previous closings of the
+    line shifted by their distance to the base, until none of them moves.
+    A missing closing (size of readings) ends the loops of its line.
+    '''
+
+    stations = np.asarray(stations)
+    lines = np.asarray(lines)
+    size = len(stations)
+    positions = np.arange(size)
+    if not size:
+        return positions, positions
+
+    line_codes = np.cumsum(np.r_[True, lines[1:] != lines[:-1]])
+    # the readings of every station of every line, ordered by their positions
+    order = np.lexsort((stations, line_codes))
+    groups = np.empty(size, dtype=int)
+    groups[order] = np.cumsum(np.r_[True, np.diff(line_codes[order]).astype(bool) | np.diff(stations[order]).astype(bool)])
+    keys = groups[order] * size + order
+    starts = groups * size
+
+    def first_after(bases, after):
+        ''' The first readings on the stations of the bases after the positions '''
+        found = np.minimum(np.searchsorted(keys, starts[bases] + after, side='right'), size - 1)
+        closings = keys[found] - starts[bases]
+        return np.where((closings > after) & (closings < size) & (stations[bases] >= 0), closings, size)
+
+    closings = first_after(positions, positions)
+    offsets = line_codes * 2 * size
+    while True:
+        # the closings go forward at least as much as the bases of the line
+        bounds = np.minimum(np.maximum.accumulate(closings - positions + offsets) - offsets + positions, size)
+        moved = np.flatnonzero(bounds > closings)
+        if not len(moved):
+            break
+        closings[moved] = first_after(moved, bounds[moved] - 1)
+
+    closed = closings < size
+    return positions[closed], closings[closed]
 
 
 def get_ties(readings):
-    ''' Get ties '''
-    ties = pd.DataFrame(columns=[
-        'date_from',
-        'date_to',
-        'created',
-        'survey_name',
-        'operator',
-        'instrument_serial_number',
-        'instr_height_from',
-        'instr_height_to',
-        'line',
-        'station_from',
-        'station_to',
-        'tie',
-        'data_file',
-        'lat_user_from',
-        'lat_user_to',
-        'lon_user_from',
-        'lon_user_to',
-        'meter_type'
-    ])
-    count = 0
-    group_by_line = readings.groupby('line')
-    for line, line_readings in group_by_line:
-        loops = []
-        for index, row in line_readings.iterrows():
-            if len(loops) == 0:
-                loops.append({
-                    'index': index,
-                    'date_time': row.date_time,
-                    'created': row.created,
-                    'survey_name': row.survey_name,
-                    'operator': row.operator,
-                    'station': row.station,
-                    'corr_grav': row.corr_grav,
-                    'instr_height': row.instr_height,
-                    'instrument_serial_number': row.instrument_serial_number,
-                    'data_file': row.data_file,
-                    'lat_user': row.lat_user,
-                    'lon_user': row.lon_user,
-                    'meter_type': row.meter_type
-                })
-                continue
-            if row.station == loops[0]['station']:
-                begin_date_time = loops[0]['date_time']
-                begin_index = loops[0]['index']
-                factor = (
-                    row.corr_grav - line_readings.loc[begin_index].corr_grav
-                ) / (
-                    dt.timestamp(row.date_time) - dt.timestamp(begin_date_time)
-                )
-                for reading in loops[1:]:
-                    correction = factor * (
-                        dt.timestamp(reading['date_time'])
-                        - dt.timestamp(begin_date_time)
-                    )
-                    ties.loc[count] = [
-                        begin_date_time,
-                        reading['date_time'],
-                        reading['created'],
-                        reading['survey_name'],
-                        reading['operator'],
-                        reading['instrument_serial_number'],
-                        reading['instr_height'],
-                        loops[0]['instr_height'],
-                        row.line,
-                        row.station,
-                        reading['station'],
-                        reading['corr_grav'] - loops[0]['corr_grav'] + correction,
-                        reading['data_file'],
-                        row.lat_user,
-                        reading['lat_user'],
-                        row.lon_user,
-                        reading['lon_user'],
-                        reading['meter_type']
-                    ]
-                    count += 1
-                loops.pop(0)
-                loops.append({
-                    'index': index,
-                    'date_time': row.date_time,
-                    'created': row.created,
-                    'survey_name': row.survey_name,
-                    'operator': row.operator,
-                    'station': row.station,
-                    'corr_grav': row.corr_grav,
-                    'instr_height': row.instr_height,
-                    'instrument_serial_number': row.instrument_serial_number,
-                    'data_file': row.data_file,
-                    'lat_user': row.lat_user,
-                    'lon_user': row.lon_user,
-                    'meter_type': row.meter_type
-                })
-            else:
-                loops.append({
-                    'index': index,
-                    'date_time': row.date_time,
-                    'created': row.created,
-                    'survey_name': row.survey_name,
-                    'operator': row.operator,
-                    'station': row.station,
-                    'corr_grav': row.corr_grav,
-                    'instr_height': row.instr_height,
-                    'instrument_serial_number': row.instrument_serial_number,
-                    'data_file': row.data_file,
-                    'lat_user': row.lat_user,
-                    'lon_user': row.lon_user,
-                    'meter_type': row.meter_type
-                })
-    return ties
+    ''' Get ties
+
+    The readings of every loop (see loop_closures) are tied to its base with
+    the correction of the linear drift between the base and closing readings.
+    '''
+
+    readings = readings.dropna(subset=['line']).sort_values('line', kind='stable')
+
+    stations, _ = pd.factorize(readings.station)
+    bases, closings = loop_closures(stations, readings.line.to_numpy())
+
+    # every reading of the loop is tied with the base and closing readings of the loop
+    counts = closings - bases - 1
+    tied = np.repeat(bases + 1 - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    bases = np.repeat(bases, counts)
+    closings = np.repeat(closings, counts)
+
+    seconds = (readings.date_time - pd.Timestamp(0)).dt.total_seconds().to_numpy()
+    corr_grav = readings.corr_grav.to_numpy(dtype=float)
+    # the drift of the loop is not defined if it is closed at the time of its base
+    instant = np.flatnonzero(seconds[closings] == seconds[bases])
+    if len(instant):
+        loop = readings.iloc[closings[instant[0]]]
+        raise ValueError(
+            f'The loop of line {loop.line} is closed at the time of its base on station {loop.station}'
+        )
+    factor = (corr_grav[closings] - corr_grav[bases]) / (seconds[closings] - seconds[bases])
+    correction = factor * (seconds[tied] - seconds[bases])
+
+    base_readings = readings.take(bases).reset_index(drop=True)
+    tied_readings = readings.take(tied).reset_index(drop=True)
+    closing_readings = readings.take(closings).reset_index(drop=True)
+
+    return pd.DataFrame(
+        {
+            'date_from': base_readings.date_time,
+            'date_to': tied_readings.date_time,
+            'created': tied_readings.created,
+            'survey_name': tied_readings.survey_name,
+            'operator': tied_readings.operator,
+            'instrument_serial_number': tied_readings.instrument_serial_number,
+            'instr_height_from': tied_readings.instr_height,
+            'instr_height_to': base_readings.instr_height,
+            'line': closing_readings.line,
+            'station_from': closing_readings.station,
+            'station_to': tied_readings.station,
+            'tie': corr_grav[tied] - corr_grav[bases] + correction,
+            'data_file': tied_readings.data_file,
+            'lat_user_from': closing_readings.lat_user,
+            'lat_user_to': tied_readings.lat_user,
+            'lon_user_from': closing_readings.lon_user,
+            'lon_user_to': tied_readings.lon_user,
+            'meter_type': tied_readings.meter_type,
+        }
+    )
 
     
 def get_meters_mean_ties(ties):
-    mean_ties = pd.DataFrame()
-    group_by_meters = ties.groupby('instrument_serial_number')
-    for meter, meter_ties in group_by_meters:
-        meter_mean_ties = get_mean_ties(meter_ties)
-        mean_ties = pd.concat([mean_ties, meter_mean_ties])
+    ''' Get mean values of ties of different meters '''
+    mean_ties = ties_means(ties, ['instrument_serial_number'])
+    # the ties of every meter are numbered from zero
+    mean_ties.index = mean_ties.groupby('instrument_serial_number', observed=True).cumcount().to_numpy()
     return mean_ties
 
 
 def get_mean_ties(ties):
     ''' Get mean values of ties '''
+    return ties_means(ties, [])
 
-    for _, row in ties.iterrows():
-        from_station = row['station_from']
-        to_station = row['station_to']
-        for tie_index, tie_row in ties.iterrows():
-            station_from = tie_row['station_from']
-            station_to = tie_row['station_to']
-            if station_from == to_station and station_to == from_station:
-                ties.loc[tie_index] = [
-                    tie_row['date_from'],
-                    tie_row['date_to'],
-                    tie_row['created'],
-                    tie_row['survey_name'],
-                    tie_row['operator'],
-                    tie_row['instrument_serial_number'],
-                    row['instr_height_to'],
-                    row['instr_height_from'],
-                    tie_row['line'],
-                    from_station,
-                    to_station,
-                    -tie_row['tie'],
-                    tie_row['data_file'],
-                    tie_row['lat_user_from'],
-                    tie_row['lat_user_to'],
-                    tie_row['lat_user_from'],
-                    tie_row['lat_user_to'],
-                    tie_row['meter_type']
-                ]
-
-    result = pd.DataFrame(columns=[
-        'station_from',
-        'station_to',
-        'created',
-        'station',
-        'operator',
-        'instrument_serial_number',
-        'line',
-        'instr_height_from',
-        'instr_height_to',
-        'tie',
-        'err',
-        'data_file',
-        'lat_user_from',
-        'lat_user_to',
-        'lon_user_from',
-        'lon_user_to',
-        'date_time',
-        'meter_type'
-    ])
-
-    means = []
-    group_by_line = ties.groupby('line')
-    for line, line_ties in group_by_line:
-        group_mean = line_ties.groupby(
-            ['station_from', 'station_to'], as_index=False)
-        mean = group_mean.agg({
-            'created': 'last',
-            'survey_name': 'last',
-            'operator': 'last',
-            'instrument_serial_number': 'last',
-            'line': 'last',
-            'instr_height_from': 'mean',
-            'instr_height_to': 'mean',
-            'tie': ['mean', 'sem'],
-            'data_file': 'last',
-            'lat_user_from': 'mean',
-            'lat_user_to': 'mean',
-            'lon_user_from': 'mean',
-            'lon_user_to': 'mean',
-            'date_to': 'last',
-            'meter_type': 'last'
-        })
-        mean.columns = [
+
+def ties_means(ties, keys):
+    ''' Mean values of ties by keys, lines and pairs of stations
+
+    All ties of the pair of stations are turned to the direction of the last
+    tie of the pair (for every keys), the input frame is not changed.
+    '''
+
+    ties = ties.reset_index(drop=True)
+
+    # the pair of stations is the ordered pair of station codes
+    stations, _ = pd.factorize(
+        np.concatenate([ties.station_from.to_numpy(), ties.station_to.to_numpy()])
+    )
+    stations_from, stations_to = stations[:len(ties)], stations[len(ties):]
+    pair_keys = [ties[key].to_numpy() for key in keys] + [
+        np.minimum(stations_from, stations_to),
+        np.maximum(stations_from, stations_to),
+    ]
+    last_from = pd.Series(stations_from).groupby(pair_keys).transform('last').to_numpy()
+    reverse = stations_from != last_from
+
+    mean_ties = ties.copy()
+    for column_from, column_to in [
+        ('station_from', 'station_to'),
+        ('instr_height_from', 'instr_height_to'),
+        ('lat_user_from', 'lat_user_to'),
+        ('lon_user_from', 'lon_user_to'),
+    ]:
+        mean_ties.loc[reverse, [column_from, column_to]] = ties.loc[reverse, [column_to, column_from]].to_numpy()
+    mean_ties['tie'] = np.where(reverse, -ties.tie.to_numpy(), ties.tie.to_numpy())
+
+    aggregations = {
+        'created': ('created', 'last'),
+        'survey_name': ('survey_name', 'last'),
+        'operator': ('operator', 'last'),
+        'instrument_serial_number': ('instrument_serial_number', 'last'),
+        'instr_height_from': ('instr_height_from', 'mean'),
+        'instr_height_to': ('instr_height_to', 'mean'),
+        'tie': ('tie', 'mean'),
+        'err': ('tie', 'sem'),
+        'data_file': ('data_file', 'last'),
+        'lat_user_from': ('lat_user_from', 'mean'),
+        'lat_user_to': ('lat_user_to', 'mean'),
+        'lon_user_from': ('lon_user_from', 'mean'),
+        'lon_user_to': ('lon_user_to', 'mean'),
+        'date_time': ('date_to', 'last'),
+        'meter_type': ('meter_type', 'last'),
+    }
+    group_by = keys + ['line', 'station_from', 'station_to']
+    mean_ties = mean_ties.groupby(group_by, as_index=False, observed=True).agg(
+        **{column: aggregation for column, aggregation in aggregations.items() if column not in group_by}
+    )
+
+    return mean_ties[
+        [
             'station_from',
             'station_to',
             'created',
@@ -435,51 +531,74 @@ def get_mean_ties(ties):
             'lon_user_from',
             'lon_user_to',
             'date_time',
-            'meter_type'
+            'meter_type',
         ]
-        means.append(mean)
-    result = pd.concat(means, ignore_index=True)
-    return result
+    ]
+
+
+def ties_graph_cycles(ties_graph, mode='auto', max_cycles=None, max_length=None):
+    ''' Cycles of the graph of ties as the lists of stations
+
+    The exhaustive mode gives all simple cycles (their number grows
+    exponentially on dense networks), the basis mode gives the fundamental
+    cycles of a spanning tree, the auto mode is exhaustive for the graphs
+    with at most EXHAUSTIVE_CYCLES_LIMIT independent cycles. The cycles
+    longer than max_length stations are skipped, at most max_cycles cycles
+    are given.
+    '''
 
+    if mode == 'auto':
+        independent_cycles = ties_graph.number_of_edges() - ties_graph.number_of_nodes() + \
+            nx.number_connected_components(ties_graph)
+        mode = 'exhaustive' if independent_cycles <= EXHAUSTIVE_CYCLES_LIMIT else 'basis'
 
-def get_ties_sum(ties):
-    ''' Get sum of ties '''
+    match mode:
+        case 'exhaustive':
+            cycles = nx.simple_cycles(ties_graph, length_bound=max_length)
+        case 'basis':
+            cycles = (
+                cycle for cycle in nx.cycle_basis(ties_graph)
+                if max_length is None or len(cycle) <= max_length
+            )
+        case _:
+            raise ValueError(f'Unknown mode of cycles: {mode}')
+
+    return islice(cycles, max_cycles)
+
+
+def get_ties_sum(ties, mode='auto', max_cycles=None, max_length=None):
+    ''' Get sum of ties along the cycles of stations (see ties_graph_cycles) '''
     meter = f'{ties.iloc[0].meter_type} #{str(ties.iloc[0].instrument_serial_number)}'
     nodes = list(ties.station_from)
     nodes.extend(list(ties.station_to))
     nodes = list(set(nodes))
-    edges = []
-    for _, row in ties.iterrows():
-        edges.append((row.station_from, row.station_to))
+    edges = list(zip(ties.station_from, ties.station_to))
 
     ties_graph = nx.Graph()
     ties_graph.add_nodes_from(nodes)
     ties_graph.add_edges_from(edges)
 
+    # the tie of the edge is the mean of its ties in both directions
+    edge_sums = {}
+    group_by_edge = ties.groupby(['station_from', 'station_to'], observed=True).tie.agg(['sum', 'count'])
+    for (station_from, station_to), tie_sum, count in zip(
+        group_by_edge.index, group_by_edge['sum'], group_by_edge['count']
+    ):
+        for edge, edge_sum in [((station_from, station_to), tie_sum), ((station_to, station_from), -tie_sum)]:
+            total, number = edge_sums.get(edge, (0.0, 0))
+            edge_sums[edge] = (total + edge_sum, number + count)
+    edge_ties = {edge: total / number for edge, (total, number) in edge_sums.items()}
+
     cicles_sum = {
         'meter': [],
         'cicle': [],
         'sum': []
     }
-    for cicle in nx.simple_cycles(ties_graph):
-        cicle.append(cicle[0])
-        cicle_ties = []
-        for station_index in range(len(cicle)-1):
-            line_ties = []
-            for _, tie_row in ties.iterrows():
-                station_from = cicle[station_index]
-                station_to = cicle[station_index+1]
-                if station_from == tie_row.station_from and\
-                        station_to == tie_row.station_to:
-                    line_ties.append(tie_row.tie)
-                elif station_from == tie_row.station_to and\
-                        station_to == tie_row.station_from:
-                    line_ties.append(-tie_row.tie)
-                else:
-                    continue
-            line_tie = sum(line_ties) / len(line_ties)
-            cicle_ties.append(line_tie)
-        cicle.pop()
+    for cicle in ties_graph_cycles(ties_graph, mode, max_cycles, max_length):
+        cicle_ties = [
+            edge_ties[(station_from, station_to)]
+            for station_from, station_to in zip(cicle, cicle[1:] + cicle[:1])
+        ]
         cicle_line = '-'.join([str(station) for station in cicle])
         cicles_sum['meter'].append(meter)
         cicles_sum['cicle'].append(cicle_line)
@@ -524,16 +643,157 @@ def to_days(value):
 def to_seconds(value):
     return value.timestamp()
 
-def free_grav_fit(stations, gravity, date_time, fix_station, std=None, max_degree=2, method='WLS'):
-    
-    observation_matrix = pd.get_dummies(stations).drop(fix_station, axis=1)
+def station_codes(stations, fix_station):
+    ''' Codes of stations in order of their names (as pd.get_dummies columns), names and code of fix_station '''
+
+    if isinstance(stations.dtype, pd.CategoricalDtype):
+        # no empty columns for the stations of the registry out of the group
+        stations = stations.cat.remove_unused_categories()
+
+    codes, names = pd.factorize(stations, sort=True)
+    fix_code = np.flatnonzero(np.asarray(names == fix_station))
+    if not len(fix_code):
+        raise KeyError(f'{fix_station} not found in stations')
+
+    return codes, np.asarray(names), fix_code[0]
+
+
+def payload_designs(payloads, max_degree=2):
+    ''' Design matrices of the payloads of fit_payloads, observations, weights and codes of tied stations
+
+    The drift polynomial of max_degree terms follows the stations, its
+    powers are increasing (as for nested_lstsq) of days since the first
+    reading: the high powers of date_days are not solvable.
+    '''
+
+    design_matrices, observations, weights, defined_codes = [], [], [], []
+    for codes, fix_code, gravity, date_time, fit_weights in payloads:
+        fit_codes = np.unique(codes)
+        fit_codes = fit_codes[fit_codes != fix_code]
+        time_matrix = np.vander(date_time - date_time[0], max_degree, increasing=True)
+        design_matrices.append(station_design(codes, fit_codes, time_matrix))
+        observations.append(gravity)
+        weights.append(fit_weights)
+        defined_codes.append(fit_codes)
+
+    return design_matrices, observations, weights, defined_codes
+
+
+def fit_payloads(payloads, max_degree=2, method='WLS', criterion=None):
+    ''' Fits of free_grav_fit for the list of payloads (codes, fix_code, gravity, date_time, weights)
+
+    The payloads are numpy arrays: codes of stations from station_codes,
+    code of the fixed station, readings, times and weights. The fits are
+    stacked to the batched solves: WLS by batch_lstsq, the rank deficient
+    fits are passed to statsmodels, RLM by huber_irls started from OLS as
+    statsmodels RLM. With criterion (see best_terms) the drift polynomials
+    of 1 to max_degree terms are fitted by nested_lstsq in one pass and the
+    best one is kept, RLM is fitted with the chosen number of terms.
+    Returns the list of (codes of tied stations, ties, their covariance
+    matrix, resid) in order of payloads.
+    '''
+
+    design_matrices, observations, weights, defined_codes = payload_designs(payloads, max_degree)
+
+    solutions = None
+    if criterion is not None:
+        models, criteria = nested_lstsq(design_matrices, observations, weights, max_degree)
+        terms = best_terms(criteria, criterion, len(payloads), max_degree)
+        design_matrices = [
+            design_matrix[:, :design_matrix.shape[1] - max_degree + model_terms]
+            for design_matrix, model_terms in zip(design_matrices, terms)
+        ]
+        solutions = [model[model_terms - 1] for model, model_terms in zip(models, terms)]
+
+    match method:
+        case 'WLS':
+            if solutions is None:
+                solutions = lstsq_fits(design_matrices, observations, weights)
+        case 'RLM':
+            solutions, _ = robust_fits(design_matrices, observations)
+
+    results = []
+    for design_matrix, gravity, fit_weights, fit_codes, solution in zip(design_matrices, observations, weights, defined_codes, solutions):
+        if solution is None:
+            result = sm.WLS(gravity, design_matrix.toarray(), weights=fit_weights).fit()
+            solution = (result.params, result.cov_params(), result.resid)
+        params, cov, resid = solution
+        stations_number = len(fit_codes)
+        results.append((fit_codes, params[:stations_number], cov[:stations_number, :stations_number], resid))
+
+    return results
+
+
+def fit_ties(fix_station, defined_stations, params, bse):
+    ''' Ties of the stations from the fix_station by the parameters of fit '''
+    return pd.DataFrame(
+        {
+            'station_from': fix_station,
+            'station_to': defined_stations,
+            'tie': params[:len(defined_stations)],
+            'err': bse[:len(defined_stations)],
+        }
+    )
+
+
+def batch_free_grav_fit(fits, max_degree=2, method='WLS', criterion=None):
+    ''' Fits of free_grav_fit for the list of fits (stations, gravity, date_time, fix_station, std)
+
+    The fits are solved together by fit_payloads. Returns the list of
+    (ties, resid) in order of fits.
+    '''
+
+    payloads, names = [], []
+    for stations, gravity, date_time, fix_station, std in fits:
+        codes, fit_names, fix_code = station_codes(stations, fix_station)
+        weights = np.ones(len(gravity)) if std is None else 1 / np.asarray(std, dtype=float)
+        payloads.append(
+            (codes, fix_code, np.asarray(gravity, dtype=float), np.asarray(date_time, dtype=float), weights)
+        )
+        names.append(fit_names)
+
+    results = []
+    for (stations, gravity, date_time, fix_station, std), fit_names, (fit_codes, params, cov, resid) in zip(fits, names, fit_payloads(payloads, max_degree, method, criterion)):
+        bse = np.sqrt(np.diagonal(cov))
+        results.append(
+            (fit_ties(fix_station, fit_names[fit_codes], params, bse), pd.Series(resid, index=gravity.index))
+        )
+
+    return results
 
-    defined_stations = observation_matrix.columns
+
+def free_grav_fit(stations, gravity, date_time, fix_station, std=None, max_degree=2, method='WLS', backend='numpy', criterion=None):
+    ''' Fit the gravity of stations relative to fix_station and the drift polynomial
+
+    The drift polynomial has max_degree terms, with criterion (aic or bic)
+    the number of terms from 1 to max_degree is chosen by the WLS fits.
+    The numpy backend solves the fit by batch_free_grav_fit, the statsmodels
+    backend fits the statsmodels model as the reference.
+    '''
+
+    if backend == 'numpy':
+        return batch_free_grav_fit([(stations, gravity, date_time, fix_station, std)], max_degree, method, criterion)[0]
+
+    codes, names, fix_code = station_codes(stations, fix_station)
+    defined_codes = np.flatnonzero(np.arange(len(names)) != fix_code)
+    defined_stations = names[defined_codes]
 
     # date_time = date_time - date_time.iloc[0]
-    time_matrix = np.vander(date_time, max_degree)
+    if criterion is not None:
+        date_time = date_time - date_time.iloc[0]
+    time_matrix = np.vander(date_time, max_degree, increasing=criterion is not None)
     
-    design_matrix = np.hstack((observation_matrix, time_matrix))
+    design_matrix = station_design(codes, defined_codes, time_matrix).toarray()
+
+    if criterion is not None:
+        check_criterion(criterion)
+        weights = np.ones(len(gravity)) if std is None else 1 / np.asarray(std, dtype=float)
+        models = [
+            sm.WLS(gravity, design_matrix[:, :len(defined_codes) + terms], weights=weights).fit()
+            for terms in range(1, max_degree + 1)
+        ]
+        values = [getattr(model, criterion) for model in models]
+        design_matrix = design_matrix[:, :len(defined_codes) + int(np.nanargmin(values)) + 1]
 
     # model = sm.RLM(input_grav, design_matrix)
     match method:
@@ -577,37 +837,26 @@ def drift_fitting(stations, grav, std_err, date_time, fix_station=None, max_degr
     date_time = date_time - date_time.iloc[0]
     times = np.vstack(date_time.dt.seconds.array)
 
-    desired_stations = stations.unique()
-    if fix_station:
-        desired_stations = desired_stations[desired_stations != fix_station]
-    else:
-        desired_stations = desired_stations[desired_stations != desired_stations[0]]
+    codes, desired_stations = pd.factorize(stations)
+    if not fix_station:
+        fix_station = desired_stations[0]
+    desired_codes = np.flatnonzero(np.asarray(desired_stations != fix_station))
     
     if max_degree > 1:
         for degree in range(2, max_degree + 1):
             times = np.hstack((times, np.power(times, degree)))
     
-    rows = []
-    for station in stations:
-        row = []
-        for desired_station in desired_stations:
-            value = 1 if desired_station == station else 0
-            row.append(value)
-        rows.append(row)
-    station_grav = np.array(rows)
-    
     ones = np.ones(shape=(readings.size, 1))
     
-    design_matrix = np.concatenate((station_grav, times, ones), axis=1)
+    design_matrix = station_design(codes, desired_codes, np.hstack((times, ones)))
     # design_matrix = np.concatenate((times, ones), axis=1)
 
     # model = sm.OLS(readings, design_matrix)
     # model = sm.WLS(readings, design_matrix, weights=np.array(std_err)**-2)
-    model = sm.RLM(readings, design_matrix)
-    
-    result = model.fit()
+    # model = sm.RLM(readings, design_matrix)
+    (params, cov, _), = robust_fits([design_matrix], [readings.ravel()])[0]
 
-    return [(value, std) for value, std in zip(result.params, result.bse)]
+    return [(value, std) for value, std in zip(params, np.sqrt(np.diagonal(cov)))]
 
 def get_meter_ties_by_lines(readings):
     
@@ -695,59 +944,238 @@ def get_meter_ties_all(readings):
 
     return pd.DataFrame(lines)
 
-def fit_by_meter_created(raw_data, anchor, method='WLS', by_lines=False):
+def group_payloads(columns, groups):
+    ''' Payloads of fit_payloads for the groups (offset, length, fix_code) of columns ordered by groups '''
+    return [
+        (
+            columns['codes'][offset:offset + length],
+            fix_code,
+            columns['gravity'][offset:offset + length],
+            columns['date_days'][offset:offset + length],
+            columns['weights'][offset:offset + length],
+        )
+        for offset, length, fix_code in groups
+    ]
+
 
-    ties = pd.DataFrame()
-    fix_station = anchor
+def fit_shared_groups(layout, groups, max_degree=2, method='WLS', criterion=None):
+    ''' fit_payloads of the groups of columns in shared memory, it is run in worker process
+
+    Only the layout of columns (see share_columns) and the groups (offset,
+    length, fix_code) are sent to the worker. The residuals are written to
+    the shared resid column. Returns the list of (codes, ties, covariance).
+    '''
+
+    columns = attach_columns(layout)
+    fits = fit_payloads(group_payloads(columns, groups), max_degree, method, criterion)
+    for (offset, length, _), (_, _, _, resid) in zip(groups, fits):
+        columns['resid'][offset:offset + length] = resid
 
+    return [(fit_codes, params, cov) for fit_codes, params, cov, _ in fits]
+
+
+def session_order(raw_data, by_lines=False):
+    ''' Groups of readings by meter, created date, survey, operator and meter type (and line)
+
+    Returns the keys of groups, group of every reading (-1 if some of its
+    keys are missing), number of readings of groups, their offsets and
+    positions of readings ordered by groups: every group is a slice of them.
+    '''
+
+    keys = ['instrument_serial_number', 'created', 'survey_name', 'operator', 'meter_type']
     if by_lines:
-        groupby = raw_data.groupby(['instrument_serial_number', 'created', 'survey_name', 'operator', 'meter_type', 'line'])
-    else:
-        groupby = raw_data.groupby(['instrument_serial_number', 'created', 'survey_name', 'operator', 'meter_type'])
-    
-    for meter_created_survey_operator_meter_type, grouped in groupby:
+        keys.append('line')
+    groupby = raw_data.groupby(keys, observed=True)
+
+    group_ids = groupby.ngroup().fillna(-1).to_numpy(dtype=int)
+    counts = np.bincount(group_ids[group_ids >= 0], minlength=groupby.ngroups)
+    offsets = np.cumsum(counts) - counts
+    order = np.argsort(group_ids, kind='stable')[len(group_ids) - counts.sum():]
+
+    return keys, group_ids, counts, offsets, order
+
+
+def session_columns(raw_data, codes, order):
+    ''' Numeric columns of fit_payloads ordered by groups (see group_payloads) '''
+    return {
+        'codes': codes[order],
+        'gravity': raw_data.corr_grav.to_numpy(dtype=float)[order],
+        'date_days': raw_data.date_days.to_numpy(dtype=float)[order],
+        'weights': 1 / raw_data.std_err.to_numpy(dtype=float)[order],
+    }
+
+
+def drift_degrees(raw_data, max_degree=4, by_lines=False):
+    ''' Criteria of the drift polynomials of 1 to max_degree terms of the groups of fit_by_meter_created
+
+    All polynomials of every group are fitted (WLS) in one pass by
+    nested_lstsq, the first station of the group is fixed. Returns the
+    frame of keys of groups, terms and criteria (see nested_lstsq) with the
+    best numbers of terms by aic and bic.
+    '''
+
+    keys, _, counts, offsets, order = session_order(raw_data, by_lines)
+    codes, _ = pd.factorize(raw_data.station, sort=True)
+    groups = zip(offsets.tolist(), counts.tolist(), codes[order[offsets]].tolist())
+    payloads = group_payloads(session_columns(raw_data, codes, order), groups)
+    design_matrices, observations, weights, _ = payload_designs(payloads, max_degree)
+    _, criteria = nested_lstsq(design_matrices, observations, weights, max_degree)
 
-        indices = grouped.index
+    problems = criteria.problem.to_numpy()
+    for criterion in ['aic', 'bic']:
+        criteria[f'best_{criterion}'] = best_terms(criteria, criterion, len(payloads), max_degree)[problems]
+    group_keys = raw_data[keys].iloc[order[offsets][problems]].reset_index(drop=True)
 
-        if anchor is None:
-            fix_station = grouped.station.iloc[0]
+    return pd.concat([group_keys, criteria.drop(columns='problem')], axis=1)
 
-        if by_lines:
-            meter, created, survey, operator, meter_type, line = meter_created_survey_operator_meter_type
+
+def group_fix_codes(anchor, codes, names, group_ids, offsets, order):
+    ''' Codes of the fixed stations of the groups of session_order: the anchor
+    (it must be in every group) or the first station of the group if None
+    '''
+
+    if anchor is None:
+        return codes[order[offsets]].tolist()
+
+    anchor_codes = np.flatnonzero(names == anchor)
+    anchor_code = anchor_codes[0] if len(anchor_codes) else -1
+    anchor_groups = np.unique(group_ids[(codes == anchor_code) & (group_ids >= 0)])
+    if len(anchor_groups) < len(offsets):
+        raise KeyError(f'{anchor} not found in stations')
+    return [anchor_code] * len(offsets)
+
+
+def group_ties(raw_data, fits, fix_codes, codes, names, group_ids, offsets, order, by_lines=False):
+    ''' Ties frame of fit_by_meter_created by the fits (codes of stations,
+    ties and errors) of the groups of session_order
+    '''
+
+    tie_groups = np.repeat(np.arange(len(fits)), [len(fit_codes) for fit_codes, _, _ in fits])
+    from_codes = np.asarray(fix_codes, dtype=int)[tie_groups]
+    to_codes = np.concatenate([np.zeros(0, dtype=int)] + [fit_codes for fit_codes, _, _ in fits])
+    first_positions = order[offsets][tie_groups]
+
+    ties = pd.DataFrame(
+        {
+            'station_from': names[from_codes],
+            'station_to': names[to_codes],
+            'tie': np.concatenate([np.zeros(0)] + [tie for _, tie, _ in fits]),
+            'err': np.concatenate([np.zeros(0)] + [err for _, _, err in fits]),
+        }
+    )
+    for column in ['instrument_serial_number', 'survey_name', 'operator', 'meter_type']:
+        ties[column] = raw_data[column].to_numpy()[first_positions]
+    ties['date_time'] = raw_data.created.iloc[first_positions].dt.date.to_numpy()
+
+    # the means of stations in the groups
+    station_means = raw_data[['lat', 'lon', 'instr_height']].groupby([group_ids, codes]).mean()
+    for codes_column, suffix in [(from_codes, 'from'), (to_codes, 'to')]:
+        means = station_means.reindex(pd.MultiIndex.from_arrays([tie_groups, codes_column]))
+        for column in ['lat', 'lon', 'instr_height']:
+            ties[f'{column}_{suffix}'] = means[column].to_numpy()
+    if by_lines:
+        ties['line'] = raw_data.line.to_numpy(dtype=float)[first_positions]
+
+    return ties
+
+
+def fit_by_meter_created(raw_data, anchor, method='WLS', by_lines=False, backend='numpy', jobs=1, cache_dir=None, max_degree=2, criterion=None):
+    ''' Fit the ties of every meter, created date, survey, operator and meter type (and line)
+
+    The drift polynomial has max_degree terms, with criterion (aic or bic)
+    the number of terms from 1 to max_degree is chosen for every group
+    (see fit_payloads). The groups are fitted by fit_payloads. With jobs > 1 the numeric
+    columns are put to shared memory ordered by groups, the workers of
+    process pool get the offsets and lengths of groups only. The fits are
+    memoized by fit_key in the process (and in cache_dir if it is not
+    None), the ties from other anchor are derived from the cached fits by
+    anchored_fit. The statsmodels backend fits free_grav_fit group by
+    group. The residuals are stored to the resid column of raw_data.
+    '''
+
+    _, group_ids, counts, offsets, order = session_order(raw_data, by_lines)
+
+    codes, names = pd.factorize(raw_data.station, sort=True)
+    names = np.asarray(names)
+    fix_codes = group_fix_codes(anchor, codes, names, group_ids, offsets, order)
+    groups = list(zip(offsets.tolist(), counts.tolist(), fix_codes))
+
+    if backend == 'numpy':
+        columns = session_columns(raw_data, codes, order)
+        payloads = group_payloads(columns, groups)
+        station_names = names.astype(str)
+        # the fits of chosen degree are cached apart from the fits of max_degree
+        fit_method = method if criterion is None else f'{method}-{criterion}'
+        fit_keys = [
+            fit_key(station_names[group_codes], gravity, date_time, weights, fit_method, max_degree)
+            for group_codes, _, gravity, date_time, weights in payloads
+        ]
+        entries = [load_fit(key, cache_dir) for key in fit_keys]
+        missed = [index for index, entry in enumerate(entries) if entry is None]
+
+        if len(missed) < 2 or jobs is None or jobs <= 1:
+            missed_fits = fit_payloads([payloads[index] for index in missed], max_degree, method, criterion)
         else:
-            meter, created, survey, operator, meter_type = meter_created_survey_operator_meter_type
-
-        fitgrav, raw_data.loc[indices, 'resid'] = free_grav_fit(
-            stations=grouped.station,
-            gravity=grouped.corr_grav,
-            date_time=grouped.date_time.apply(to_days),
-            fix_station=fix_station,
-            std=grouped.std_err,
-            max_degree=2,
-            method=method,
+            columns['resid'] = np.full(len(order), np.nan)
+            block, layout = share_columns(columns)
+            try:
+                # the chunks of groups keep the batched solves in workers
+                chunks = np.array_split(np.array(missed), min(jobs, len(missed)))
+                with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+                    chunks_fits = executor.map(
+                        fit_shared_groups,
+                        repeat(layout),
+                        [[groups[index] for index in chunk] for chunk in chunks],
+                        repeat(max_degree),
+                        repeat(method),
+                        repeat(criterion)
+                    )
+                    missed_fits = [fit for chunk_fits in chunks_fits for fit in chunk_fits]
+                shared_resid = read_column(block, layout, 'resid')
+            finally:
+                block.close()
+                block.unlink()
+            missed_fits = [
+                (fit_codes, params, cov, shared_resid[groups[index][0]:groups[index][0] + groups[index][1]])
+                for index, (fit_codes, params, cov) in zip(missed, missed_fits)
+            ]
+
+        for index, (fit_codes, params, cov, resid) in zip(missed, missed_fits):
+            entries[index] = fit_entry(station_names[fix_codes[index]], station_names[fit_codes], params, cov, resid)
+        store_fits([fit_keys[index] for index in missed], [entries[index] for index in missed], cache_dir)
+
+        anchored = [anchored_fit(entry, station_names[fix_code]) for entry, fix_code in zip(entries, fix_codes)]
+        fit_codes = pd.Index(station_names).get_indexer(
+            np.concatenate([np.zeros(0, dtype=str)] + [fit_stations for fit_stations, _, _, _ in anchored])
         )
-        fitgrav['instrument_serial_number'] = meter
-        fitgrav['survey_name'] = survey
-        fitgrav['operator'] = operator
-        fitgrav['meter_type'] = meter_type
-        fitgrav['date_time'] = created.date()
-        instr_height_from = grouped.loc[grouped.station == fix_station, 'instr_height'].mean()
-        lat_from = grouped.loc[grouped.station == fix_station, 'lat'].mean()
-        lon_from = grouped.loc[grouped.station == fix_station, 'lon'].mean()
-        fitgrav['lat_from'] = lat_from
-        fitgrav['lon_from'] = lon_from
-        fitgrav['instr_height_from'] = instr_height_from
-        for idx, row in fitgrav.iterrows():
-            lat_to = grouped.loc[grouped.station == row.station_to, 'lat'].mean()
-            lon_to = grouped.loc[grouped.station == row.station_to, 'lon'].mean()
-            instr_height_to = grouped.loc[grouped.station == row.station_to, 'instr_height'].mean()
-            fitgrav.loc[idx, 'lat_to'] = lat_to
-            fitgrav.loc[idx, 'lon_to'] = lon_to
-            fitgrav.loc[idx, 'instr_height_to'] = instr_height_to
-            if by_lines:
-                fitgrav.loc[idx, 'line'] = int(line)
-
-        ties = pd.concat([ties, fitgrav], ignore_index=True)
-    
-    return ties
- 
\ No newline at end of file
+        fit_splits = np.cumsum([len(fit_stations) for fit_stations, _, _, _ in anchored])[:-1]
+        fits = [
+            (group_fit_codes, tie, err)
+            for group_fit_codes, (_, tie, err, _) in zip(np.split(fit_codes, fit_splits), anchored)
+        ]
+        group_resid = np.concatenate([np.zeros(0)] + [resid for _, _, _, resid in anchored])
+    else:
+        fits, group_resid = [], []
+        for offset, length, fix_code in groups:
+            grouped = raw_data.iloc[order[offset:offset + length]]
+            fitgrav, resid = free_grav_fit(
+                stations=grouped.station,
+                gravity=grouped.corr_grav,
+                date_time=grouped.date_days,
+                fix_station=names[fix_code],
+                std=grouped.std_err,
+                max_degree=max_degree,
+                method=method,
+                backend=backend,
+                criterion=criterion,
+            )
+            fit_codes = pd.Index(names).get_indexer(fitgrav.station_to)
+            fits.append((fit_codes, fitgrav.tie.to_numpy(), fitgrav.err.to_numpy()))
+            group_resid.append(np.asarray(resid))
+        group_resid = np.concatenate([np.zeros(0)] + group_resid)
+
+    resid = np.full(len(raw_data), np.nan)
+    resid[order] = group_resid
+    raw_data['resid'] = resid
+
+    return group_ties(raw_data, fits, fix_codes, codes, names, group_ids, offsets, order, by_lines)
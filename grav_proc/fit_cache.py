@@ -0,0 +1,130 @@
+'''
+Memoized fits of the groups of readings
+'''
+
+from collections import OrderedDict
+import hashlib
+import os
+import numpy as np
+from grav_proc.cache import DEFAULT_CACHE_SIZE, evict_cached
+
+# number of fits kept in the process
+FIT_CACHE_ENTRIES = 4096
+
+# suffix of the fit files in the cache directory
+FIT_CACHE_SUFFIX = '.npz'
+
+# the fits kept in the process, the least recently used first
+FIT_CACHE = OrderedDict()
+
+# version of the solvers of the fits, change it to invalidate the cached fits
+FIT_VERSION = 2
+
+
+def fit_key(stations, gravity, date_time, weights, method, max_degree):
+    ''' Key of the fit of the group: hash of FIT_VERSION, its readings, method and degree
+
+    The fixed station is not in the key, the fit of the group with any
+    fixed station is derived from the cached one by anchored_fit.
+    '''
+
+    names, codes = np.unique(np.asarray(stations).astype(str), return_inverse=True)
+    key_hash = hashlib.sha256(f'{FIT_VERSION}-{method}-{max_degree}'.encode())
+    key_hash.update('\0'.join(names).encode())
+    key_hash.update(np.ascontiguousarray(codes, dtype=np.int64).tobytes())
+    for values in [gravity, date_time, weights]:
+        key_hash.update(np.ascontiguousarray(values, dtype=float).tobytes())
+    return key_hash.hexdigest()
+
+
+def fit_entry(fix_station, stations, params, cov, resid):
+    ''' Cached fit: all stations of the group (sorted), their gravities
+    relative to the fix_station and covariance matrix (zero for the
+    fix_station) and the residuals of readings
+    '''
+
+    stations = np.asarray(stations).astype(str)
+    names = np.sort(np.append(stations, str(fix_station)))
+    positions = np.searchsorted(names, stations)
+    full_params = np.zeros(len(names))
+    full_params[positions] = params
+    full_cov = np.zeros((len(names), len(names)))
+    full_cov[np.ix_(positions, positions)] = cov
+
+    return {'stations': names, 'params': full_params, 'cov': full_cov, 'resid': np.asarray(resid, dtype=float)}
+
+
+def anchored_fit(entry, fix_station):
+    ''' Ties of the cached fit from the fix_station by the differences of parameters
+
+    The tie of station s is params[s] - params[fix], its variance is
+    cov[s, s] + cov[fix, fix] - 2 cov[s, fix]. Returns the stations, ties,
+    their errors and the residuals (they do not depend on the fix_station).
+    '''
+
+    names = entry['stations']
+    fix = np.flatnonzero(names == str(fix_station))
+    if not len(fix):
+        raise KeyError(f'{fix_station} not found in stations')
+    fix = fix[0]
+
+    params, cov = entry['params'], entry['cov']
+    variances = np.diagonal(cov) + cov[fix, fix] - 2 * cov[:, fix]
+    tied = np.arange(len(names)) != fix
+
+    return names[tied], (params - params[fix])[tied], np.sqrt(np.maximum(variances[tied], 0)), entry['resid']
+
+
+def load_fit(key, cache_dir=None):
+    ''' Get the fit from the process or the cache_dir, None if there is no fit '''
+
+    if key in FIT_CACHE:
+        FIT_CACHE.move_to_end(key)
+        return FIT_CACHE[key]
+    if cache_dir is None:
+        return None
+
+    path = os.path.join(cache_dir, key + FIT_CACHE_SUFFIX)
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            entry = {name: data[name] for name in ['stations', 'params', 'cov', 'resid']}
+    except (OSError, ValueError, KeyError):
+        return None
+    # the last access time is the order of eviction
+    os.utime(path)
+    remember_fit(key, entry)
+
+    return entry
+
+
+def remember_fit(key, entry):
+    ''' Keep the fit in the process, the least recently used ones are dropped '''
+    FIT_CACHE[key] = entry
+    FIT_CACHE.move_to_end(key)
+    while len(FIT_CACHE) > FIT_CACHE_ENTRIES:
+        FIT_CACHE.popitem(last=False)
+
+
+def store_fits(keys, entries, cache_dir=None, max_size=DEFAULT_CACHE_SIZE):
+    ''' Put the fits to the process and to the cache_dir (if it is not None), then evict the old files once '''
+
+    for key, entry in zip(keys, entries):
+        remember_fit(key, entry)
+    if cache_dir is None or not keys:
+        return
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError:
+        return
+    for key, entry in zip(keys, entries):
+        path = os.path.join(cache_dir, key + FIT_CACHE_SUFFIX)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(temp_path, 'wb') as fit_file:
+                np.savez(fit_file, **entry)
+            os.replace(temp_path, path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    evict_cached(cache_dir, max_size, FIT_CACHE_SUFFIX)
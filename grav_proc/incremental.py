@@ -0,0 +1,233 @@
+'''
+Incremental least squares of the growing session of readings
+'''
+
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+from scipy.linalg import solve_triangular
+from grav_proc.calculations import fit_ties, group_fix_codes, group_ties, session_order
+
+# suffix of the state files in the state directory
+STATE_SUFFIX = '.npz'
+
+
+def new_state(fix_station=None, max_degree=2, time_origin=None):
+    ''' Empty state of the fit of free_grav_fit (WLS)
+
+    The state is the square root information form of the fit: upper
+    triangular R and Q^T y of the QR decomposition of the weighted design,
+    the weighted sum of squared residuals and the number of readings. The
+    parameters are the drift polynomial of max_degree terms (as np.vander,
+    of days since the time_origin) and then the stations in order of their
+    appearance. The fix_station and the time_origin are taken from the
+    first readings if None.
+    '''
+
+    return {
+        'fix_station': fix_station,
+        'max_degree': max_degree,
+        'time_origin': time_origin,
+        'stations': [],
+        'r_matrix': np.zeros((max_degree, max_degree)),
+        'qty': np.zeros(max_degree),
+        'ssr': 0.0,
+        'readings': 0,
+    }
+
+
+def update_state(state, stations, gravity, date_time, weights=None):
+    ''' Update the state by the appended readings, returns the new state
+
+    The new stations are appended to the parameters. The rows of readings
+    are added to the R factor by one QR decomposition of the stacked
+    (parameters + 1 + readings, parameters + 1) matrix, so the cost does
+    not depend on the number of readings of the state.
+    '''
+
+    stations = np.asarray(stations).astype(str)
+    gravity = np.asarray(gravity, dtype=float)
+    date_time = np.asarray(date_time, dtype=float)
+    weights = np.ones(len(gravity)) if weights is None else np.asarray(weights, dtype=float)
+    if not len(gravity):
+        return state
+
+    state = dict(state)
+    if state['fix_station'] is None:
+        state['fix_station'] = stations[0]
+    if state['time_origin'] is None:
+        state['time_origin'] = date_time[0]
+
+    new_stations = [
+        station for station in pd.unique(stations)
+        if station != state['fix_station'] and station not in state['stations']
+    ]
+    state['stations'] = state['stations'] + new_stations
+    # the columns of new stations are appended, so R stays upper triangular
+    r_matrix = np.pad(state['r_matrix'], ((0, len(new_stations)), (0, len(new_stations))))
+    qty = np.pad(state['qty'], (0, len(new_stations)))
+
+    max_degree = state['max_degree']
+    parameters = len(qty)
+    design_matrix = np.zeros((len(gravity), parameters))
+    design_matrix[:, :max_degree] = np.vander(date_time - state['time_origin'], max_degree)
+    codes = pd.Index(state['stations']).get_indexer(stations)
+    station_rows = np.flatnonzero(codes >= 0)
+    design_matrix[station_rows, max_degree + codes[station_rows]] = 1
+
+    root_weights = np.sqrt(weights)[:, None]
+    stacked = np.vstack(
+        (
+            np.column_stack((r_matrix, qty)),
+            np.append(np.zeros(parameters), np.sqrt(state['ssr'])),
+            np.column_stack((design_matrix, gravity)) * root_weights,
+        )
+    )
+    r_augmented = np.linalg.qr(stacked, mode='r')
+
+    state['r_matrix'] = r_augmented[:parameters, :parameters]
+    state['qty'] = r_augmented[:parameters, parameters]
+    state['ssr'] = r_augmented[parameters, parameters]**2
+    state['readings'] += len(gravity)
+
+    return state
+
+
+def append_readings(state, readings):
+    ''' Update the state by the readings of the session frame (make_frame_to_proc)
+
+    The frame is the whole session read again, its first readings are
+    in the state already, so only the rest of them are added.
+    '''
+    new_readings = readings.iloc[state['readings']:]
+    return update_state(
+        state,
+        new_readings.station,
+        new_readings.corr_grav,
+        new_readings.date_days,
+        1 / new_readings.std_err.to_numpy(dtype=float),
+    )
+
+
+def state_solution(state):
+    ''' Parameters of the state and their standard errors
+
+    Returns the ties (as free_grav_fit) of the stations, the drift
+    coefficients and their errors. They are NaN while the fit is rank
+    deficient.
+    '''
+
+    r_matrix = state['r_matrix']
+    parameters = len(r_matrix)
+    diagonal = np.abs(np.diagonal(r_matrix))
+    if state['readings'] < parameters or diagonal.min() <= diagonal.max() * parameters * np.finfo(float).eps:
+        params = np.full(parameters, np.nan)
+        bse = np.full(parameters, np.nan)
+    else:
+        params = solve_triangular(r_matrix, state['qty'])
+        dof = state['readings'] - parameters
+        scale = state['ssr'] / dof if dof > 0 else np.nan
+        r_inverse = solve_triangular(r_matrix, np.eye(parameters))
+        bse = np.sqrt(scale * np.sum(r_inverse**2, axis=1))
+
+    max_degree = state['max_degree']
+    order = np.argsort(state['stations'], kind='stable')
+    ties = fit_ties(
+        state['fix_station'],
+        np.asarray(state['stations'], dtype=str)[order],
+        params[max_degree:][order],
+        bse[max_degree:][order],
+    )
+
+    return ties, params[:max_degree], bse[:max_degree]
+
+
+def save_state(state, path):
+    ''' Write the state to the npz file, the file is replaced atomically '''
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as state_file:
+        np.savez(
+            state_file,
+            fix_station=np.array('' if state['fix_station'] is None else state['fix_station']),
+            max_degree=np.array(state['max_degree']),
+            time_origin=np.array(np.nan if state['time_origin'] is None else state['time_origin']),
+            stations=np.array(state['stations'], dtype=str),
+            r_matrix=state['r_matrix'],
+            qty=state['qty'],
+            ssr=np.array(state['ssr']),
+            readings=np.array(state['readings']),
+        )
+    os.replace(temp_path, path)
+
+
+def load_state(path):
+    ''' Read the state of save_state '''
+    with np.load(path, allow_pickle=False) as data:
+        fix_station = str(data['fix_station'])
+        time_origin = float(data['time_origin'])
+        return {
+            'fix_station': fix_station or None,
+            'max_degree': int(data['max_degree']),
+            'time_origin': None if np.isnan(time_origin) else time_origin,
+            'stations': [str(station) for station in data['stations']],
+            'r_matrix': data['r_matrix'],
+            'qty': data['qty'],
+            'ssr': float(data['ssr']),
+            'readings': int(data['readings']),
+        }
+
+
+def state_path(state_dir, session_keys):
+    ''' Path of the state of the session in the state_dir: hash of the keys of the session '''
+    key_hash = hashlib.sha256('\0'.join(str(key) for key in session_keys).encode())
+    return os.path.join(state_dir, f'{key_hash.hexdigest()}{STATE_SUFFIX}')
+
+
+def session_states(raw_data, state_dir, anchor=None, by_lines=False, max_degree=2):
+    ''' Fit the ties of the groups of fit_by_meter_created (WLS) by their states in the state_dir
+
+    The state of every group is loaded, updated by the readings appended
+    since the last run (append_readings) and saved, so the growing session
+    is not fitted from the start. The state is started again if the group
+    has less readings than it, or the fixed station or max_degree are
+    changed. Returns the ties as fit_by_meter_created, the residuals are
+    stored to the resid column of raw_data.
+    '''
+
+    keys, group_ids, counts, offsets, order = session_order(raw_data, by_lines)
+
+    codes, names = pd.factorize(raw_data.station, sort=True)
+    names = np.asarray(names)
+    fix_codes = group_fix_codes(anchor, codes, names, group_ids, offsets, order)
+
+    os.makedirs(state_dir, exist_ok=True)
+    first_readings = raw_data[keys].iloc[order[offsets]].itertuples(index=False)
+    fits = []
+    resid = np.full(len(raw_data), np.nan)
+    for offset, count, fix_code, session_keys in zip(offsets, counts, fix_codes, first_readings):
+        positions = order[offset:offset + count]
+        readings = raw_data.iloc[positions]
+        fix_station = str(names[fix_code])
+
+        path = state_path(state_dir, session_keys)
+        state = load_state(path) if os.path.exists(path) else None
+        if (
+            state is None or state['readings'] > count
+            or state['fix_station'] != fix_station or state['max_degree'] != max_degree
+        ):
+            state = new_state(fix_station, max_degree)
+        state = append_readings(state, readings)
+        save_state(state, path)
+
+        ties, drift, _ = state_solution(state)
+        fits.append((pd.Index(names.astype(str)).get_indexer(ties.station_to), ties.tie.to_numpy(), ties.err.to_numpy()))
+        station_gravity = pd.Series(ties.tie.to_numpy(), index=ties.station_to)
+        resid[positions] = (
+            readings.corr_grav.to_numpy(dtype=float)
+            - np.vander(readings.date_days.to_numpy(dtype=float) - state['time_origin'], max_degree) @ drift
+            - station_gravity.reindex(readings.station.astype(str)).fillna(0).to_numpy()
+        )
+    raw_data['resid'] = resid
+
+    return group_ties(raw_data, fits, fix_codes, codes, names, group_ids, offsets, order, by_lines)
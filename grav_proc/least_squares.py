@@ -0,0 +1,377 @@
+'''
+Batched least squares solvers of many small problems
+'''
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# tuning constant of the Huber norm (as statsmodels HuberT)
+HUBER_T = 1.345
+
+# the median absolute deviation of standard normal distribution
+MAD_NORMAL = 0.6744897501960817
+
+# relative cutoff of small singular values (as numpy.linalg.pinv)
+PINV_RCOND = 1e-15
+
+# number of elements of the stacked design matrices of one batch
+BATCH_ELEMENTS = 2**24
+
+# criteria of the choice of nested models by best_terms (the minimum is the best),
+# the rms of nested_lstsq is not one: it does not increase with the terms
+MODEL_CRITERIA = ('aic', 'bic')
+
+
+def size_slices(sizes, limit=BATCH_ELEMENTS):
+    ''' Slices of consecutive items with the sum of sizes not more than limit (or of one item) '''
+    start, total = 0, 0
+    for index, size in enumerate(sizes):
+        if index > start and total + size > limit:
+            yield slice(start, index)
+            start, total = index, 0
+        total += size
+    if start < len(sizes):
+        yield slice(start, len(sizes))
+
+
+def station_design(codes, defined_codes, time_matrix):
+    ''' Sparse design matrix of the stations and the polynomial of time
+
+    codes are the integer codes of stations of readings, the columns of the
+    one-hot block are the defined_codes (the fixed station is not among
+    them), time_matrix is the dense (readings, terms) block of time.
+    '''
+
+    codes = np.asarray(codes)
+    defined_codes = np.asarray(defined_codes, dtype=int)
+    time_matrix = np.asarray(time_matrix, dtype=float)
+    rows, terms = time_matrix.shape
+    lookup = np.full(max(codes.max(initial=-1), defined_codes.max(initial=-1)) + 1, -1)
+    lookup[defined_codes] = np.arange(len(defined_codes))
+    station_columns = lookup[codes]
+    observed = station_columns >= 0
+
+    # every row is the station column (if it is defined) and the time columns
+    row_sizes = observed + terms
+    indptr = np.zeros(rows + 1, dtype=np.int64)
+    np.cumsum(row_sizes, out=indptr[1:])
+    indices = np.empty(indptr[-1], dtype=np.int64)
+    data = np.empty(indptr[-1])
+    starts = indptr[:-1][observed]
+    indices[starts] = station_columns[observed]
+    data[starts] = 1
+    time_positions = (indptr[:-1] + observed)[:, None] + np.arange(terms)
+    indices[time_positions] = len(defined_codes) + np.arange(terms)
+    data[time_positions] = time_matrix
+
+    return sparse.csr_matrix((data, indices, indptr), shape=(rows, len(defined_codes) + terms))
+
+
+def stack_problems(design_matrices, observations, weights=None):
+    ''' Stack the problems with the same number of columns to batches
+
+    Yields (indices, design_matrices, observations, weights) of the
+    batches. The rows of shorter problems are padded with zero weight, the
+    number of rows of batch is the power of two not less than the columns.
+    The batches are split to BATCH_ELEMENTS of the stacked design, the
+    sparse design matrices are scattered to it without the dense copies.
+    '''
+
+    batches = {}
+    for index, design_matrix in enumerate(design_matrices):
+        rows, columns = design_matrix.shape
+        rows = max(1 << (rows - 1).bit_length(), columns)
+        batches.setdefault((rows, columns), []).append(index)
+
+    for (rows, columns), batch_indices in batches.items():
+        for part in size_slices([rows * columns] * len(batch_indices)):
+            indices = batch_indices[part]
+            batch_design = np.zeros((len(indices), rows, columns))
+            batch_observations = np.zeros((len(indices), rows))
+            batch_weights = np.zeros((len(indices), rows))
+            for batch_index, index in enumerate(indices):
+                problem_rows = len(observations[index])
+                if sparse.issparse(design_matrices[index]):
+                    design_matrix = design_matrices[index].tocsr()
+                    design_rows = np.repeat(np.arange(problem_rows), np.diff(design_matrix.indptr))
+                    batch_design[batch_index, design_rows, design_matrix.indices] = design_matrix.data
+                else:
+                    batch_design[batch_index, :problem_rows] = design_matrices[index]
+                batch_observations[batch_index, :problem_rows] = observations[index]
+                batch_weights[batch_index, :problem_rows] = 1 if weights is None else weights[index]
+            yield indices, batch_design, batch_observations, batch_weights
+
+
+def batch_lstsq(design_matrices, observations, weights):
+    ''' Weighted least squares of the stack of problems by the QR decomposition
+
+    The arrays are (problems, rows, parameters), (problems, rows) and
+    (problems, rows), the rows of zero weight pad the shorter problems.
+    Returns params, their covariance matrices from the R factor, residuals
+    and the flags of full rank problems, the results of other ones are not
+    valid.
+    '''
+
+    root_weights = np.sqrt(weights)
+    q_matrix, r_matrix = np.linalg.qr(design_matrices * root_weights[:, :, None])
+
+    diagonal = np.abs(np.diagonal(r_matrix, axis1=1, axis2=2))
+    full_rank = diagonal.min(axis=1) > diagonal.max(axis=1) * design_matrices.shape[2] * np.finfo(float).eps
+    # the problems with singular R are solved with unit matrix to be skipped
+    r_matrix[~full_rank] = np.eye(design_matrices.shape[2])
+
+    qty = np.swapaxes(q_matrix, 1, 2) @ (root_weights * observations)[:, :, None]
+    params = np.linalg.solve(r_matrix, qty)[:, :, 0]
+    resid = observations - (design_matrices @ params[:, :, None])[:, :, 0]
+
+    rows = np.count_nonzero(weights, axis=1)
+    dof = rows - design_matrices.shape[2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.where(dof > 0, np.sum(weights * resid**2, axis=1) / dof, np.nan)
+    r_inverse = np.linalg.inv(r_matrix)
+    cov = scale[:, None, None] * (r_inverse @ np.swapaxes(r_inverse, 1, 2))
+
+    return params, cov, resid, full_rank
+
+
+def nested_lstsq(design_matrices, observations, weights=None, nested_terms=1):
+    ''' Weighted least squares of the nested models of the list of problems
+
+    The models of problem are its design matrix without the last columns:
+    the last nested_terms columns are added one by one. All models are
+    solved from one QR decomposition of the full design, the R factor of
+    the model is the leading block of R and its right side is the leading
+    part of Q^T y.
+
+    Returns the list of models of every problem as (params, cov, resid),
+    None for rank deficient models, and the frame of criteria of models:
+    problem, terms, nobs, ssr, llf, aic, bic (as statsmodels WLS) and rms of
+    the residuals.
+    '''
+
+    results = [[None] * nested_terms for _ in design_matrices]
+    criteria = []
+    for indices, batch_design, batch_observations, batch_weights in stack_problems(design_matrices, observations, weights):
+        root_weights = np.sqrt(batch_weights)
+        q_matrix, r_matrix = np.linalg.qr(batch_design * root_weights[:, :, None])
+        qty = (np.swapaxes(q_matrix, 1, 2) @ (root_weights * batch_observations)[:, :, None])[:, :, 0]
+        diagonal = np.abs(np.diagonal(r_matrix, axis1=1, axis2=2))
+
+        valid = batch_weights > 0
+        nobs = valid.sum(axis=1)
+        with np.errstate(divide='ignore'):
+            log_weights = np.sum(np.where(valid, np.log(np.where(valid, batch_weights, 1)), 0), axis=1)
+
+        columns = batch_design.shape[2]
+        for terms in range(1, nested_terms + 1):
+            model_columns = columns - nested_terms + terms
+            model_diagonal = diagonal[:, :model_columns]
+            full_rank = model_diagonal.min(axis=1) > model_diagonal.max(axis=1) * model_columns * np.finfo(float).eps
+            model_r = r_matrix[:, :model_columns, :model_columns].copy()
+            # the rank deficient models are solved with unit matrix to be skipped
+            model_r[~full_rank] = np.eye(model_columns)
+
+            params = np.linalg.solve(model_r, qty[:, :model_columns, None])[:, :, 0]
+            resid = batch_observations - (batch_design[:, :, :model_columns] @ params[:, :, None])[:, :, 0]
+            ssr = np.sum(batch_weights * resid**2, axis=1)
+            dof = nobs - model_columns
+            with np.errstate(divide='ignore', invalid='ignore'):
+                scale = np.where(dof > 0, ssr / dof, np.nan)
+                llf = -nobs / 2 * (np.log(2 * np.pi) + np.log(ssr / nobs) + 1) + log_weights / 2
+            r_inverse = np.linalg.inv(model_r)
+            cov = scale[:, None, None] * (r_inverse @ np.swapaxes(r_inverse, 1, 2))
+
+            criteria.append(
+                pd.DataFrame(
+                    {
+                        'problem': indices,
+                        'terms': terms,
+                        'nobs': nobs,
+                        'ssr': np.where(full_rank, ssr, np.nan),
+                        'llf': np.where(full_rank, llf, np.nan),
+                        'aic': np.where(full_rank, 2 * model_columns - 2 * llf, np.nan),
+                        'bic': np.where(full_rank, np.log(nobs) * model_columns - 2 * llf, np.nan),
+                        'rms': np.where(full_rank, np.sqrt(np.sum(valid * resid**2, axis=1) / nobs), np.nan),
+                    }
+                )
+            )
+            for batch_index, index in enumerate(indices):
+                if full_rank[batch_index]:
+                    rows = len(observations[index])
+                    results[index][terms - 1] = (params[batch_index], cov[batch_index], resid[batch_index, :rows])
+
+    if not criteria:
+        return results, pd.DataFrame(columns=['problem', 'terms', 'nobs', 'ssr', 'llf', 'aic', 'bic', 'rms'])
+
+    criteria = pd.concat(criteria).sort_values(['problem', 'terms'], kind='stable').reset_index(drop=True)
+
+    return results, criteria
+
+
+def check_criterion(criterion):
+    ''' ValueError for the unknown criterion of the choice of nested models '''
+    if criterion not in MODEL_CRITERIA:
+        raise ValueError(f'Unknown criterion {criterion}, it should be one of {", ".join(MODEL_CRITERIA)}')
+
+
+def best_terms(criteria, criterion='bic', problems=None, default=1):
+    ''' Number of terms of the best model of every problem by the criteria of nested_lstsq
+
+    The model with the minimal criterion is the best, the problems without
+    valid models get the default. Returns the array of terms in order of
+    problems (0 to problems - 1, all of criteria if None).
+    '''
+
+    check_criterion(criterion)
+
+    if problems is None:
+        problems = int(criteria.problem.max()) + 1 if len(criteria) else 0
+    valid = criteria.dropna(subset=[criterion])
+    best = valid.loc[valid.groupby('problem')[criterion].idxmin(), ['problem', 'terms']]
+
+    return best.set_index('problem').terms.reindex(range(problems), fill_value=default).to_numpy(dtype=int)
+
+
+def huber_rho(scaled_resid, tuning=HUBER_T):
+    absolute = np.abs(scaled_resid)
+    return np.where(absolute <= tuning, 0.5 * scaled_resid**2, tuning * absolute - 0.5 * tuning**2)
+
+
+def huber_weights(scaled_resid, tuning=HUBER_T):
+    absolute = np.abs(scaled_resid)
+    with np.errstate(divide='ignore'):
+        return np.where(absolute <= tuning, 1.0, tuning / absolute)
+
+
+def mad_scale(resid, valid):
+    ''' Median absolute deviation from zero of the valid residuals '''
+    return np.nanmedian(np.where(valid, np.abs(resid), np.nan), axis=1) / MAD_NORMAL
+
+
+def huber_irls(design_matrices, observations, weights, tuning=HUBER_T, tol=1e-8, max_iterations=50):
+    ''' Huber M-estimation of the stack of problems by iteratively reweighted least squares
+
+    The arrays are as in batch_lstsq, the first fit is weighted by the
+    weights: ones for the start from OLS as in statsmodels RLM or the
+    weights of the WLS solution for the warm start. The iterations follow
+    statsmodels RLM with the default options (MAD scale, deviance
+    convergence, H1 covariance).
+
+    The design matrices are factorized by SVD once, the reweighted problems
+    are solved in the coordinates of the left singular vectors. The small
+    singular values are dropped as in pinv, so the rank deficient problems
+    get the minimal norm solution.
+
+    Returns params, their covariance matrices, residuals and the frame of
+    diagnostics: iterations, converged flag and scale of every problem.
+    '''
+
+    problems, rows, columns = design_matrices.shape
+    valid = weights > 0
+    nobs = valid.sum(axis=1)
+
+    left, singular, right = np.linalg.svd(design_matrices, full_matrices=False)
+    kept = singular > singular[:, :1] * PINV_RCOND
+    inverse_singular = np.where(kept, 1 / np.where(kept, singular, 1), 0)
+    left = left * kept[:, None, :]
+    rank = np.count_nonzero(singular > singular[:, :1] * nobs[:, None] * np.finfo(float).eps, axis=1)
+    # the dropped directions are solved to zero by unit matrix
+    dropped = np.eye(columns) * ~kept[:, None, :]
+
+    def weighted_fit(indices, fit_weights, dof):
+        weighted_left = left[indices] * fit_weights[:, :, None]
+        normal = np.swapaxes(weighted_left, 1, 2) @ left[indices] + dropped[indices]
+        rhs = np.swapaxes(weighted_left, 1, 2) @ observations[indices, :, None]
+        coordinates = np.linalg.solve(normal, rhs)[:, :, 0]
+        params = (np.swapaxes(right[indices], 1, 2) @ (coordinates * inverse_singular[indices])[:, :, None])[:, :, 0]
+        resid = observations[indices] - (design_matrices[indices] @ params[:, :, None])[:, :, 0]
+        resid[~valid[indices]] = 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # statsmodels measures the deviance by the scale of the weighted fit
+            fit_scale = np.sum(fit_weights * resid**2, axis=1) / dof
+            deviance = np.sum(huber_rho(resid / fit_scale[:, None], tuning) * valid[indices], axis=1)
+        return params, resid, deviance
+
+    indices = np.arange(problems)
+    params, resid, deviance = weighted_fit(indices, weights, nobs - rank)
+    scale = mad_scale(resid, valid)
+    iterations = np.ones(problems, dtype=int)
+    converged = np.zeros(problems, dtype=bool)
+
+    # the perfect fit can not be reweighted
+    active = scale > 0
+    converged[~active] = True
+    while active.any():
+        indices = np.flatnonzero(active)
+        with np.errstate(invalid='ignore'):
+            fit_weights = huber_weights(resid[indices] / scale[indices, None], tuning) * valid[indices]
+        new_params, new_resid, new_deviance = weighted_fit(indices, fit_weights, nobs[indices] - columns)
+        params[indices], resid[indices] = new_params, new_resid
+        scale[indices] = mad_scale(new_resid, valid[indices])
+        iterations[indices] += 1
+        converged[indices] = np.abs(new_deviance - deviance[indices]) <= tol
+        deviance[indices] = new_deviance
+        active[indices] = ~converged[indices] & (iterations[indices] < max_iterations) & (scale[indices] > 0)
+
+    dof = nobs - rank
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scaled_resid = np.where(scale[:, None] > 0, resid / scale[:, None], 0)
+        psi = np.clip(scaled_resid, -tuning, tuning) * valid
+        psi_deriv = (np.abs(scaled_resid) <= tuning) & valid
+        mean_deriv = psi_deriv.sum(axis=1) / nobs
+        var_deriv = mean_deriv - mean_deriv**2
+        correction = 1 + rank / nobs * var_deriv / mean_deriv**2
+        factor = correction**2 * np.sum(psi**2, axis=1) / dof * scale**2 / mean_deriv**2
+    normalized_cov = np.swapaxes(right, 1, 2) @ (right * inverse_singular[:, :, None]**2)
+    cov = factor[:, None, None] * normalized_cov
+
+    diagnostics = pd.DataFrame({'iterations': iterations, 'converged': converged, 'scale': scale})
+
+    return params, cov, resid, diagnostics
+
+
+def lstsq_fits(design_matrices, observations, weights=None):
+    ''' Weighted least squares of the list of problems, stacked by stack_problems
+
+    Returns the list of (params, cov, resid), None for rank deficient problems.
+    '''
+
+    results = [None] * len(design_matrices)
+    for indices, batch_design, batch_observations, batch_weights in stack_problems(design_matrices, observations, weights):
+        params, cov, resid, full_rank = batch_lstsq(batch_design, batch_observations, batch_weights)
+        for batch_index, index in enumerate(indices):
+            if full_rank[batch_index]:
+                rows = len(observations[index])
+                results[index] = (params[batch_index], cov[batch_index], resid[batch_index, :rows])
+
+    return results
+
+
+def robust_fits(design_matrices, observations, weights=None, tuning=HUBER_T, tol=1e-8, max_iterations=50):
+    ''' Huber M-estimation of the list of problems, stacked by stack_problems
+
+    The weights are the weights of warm start, see huber_irls. Returns the
+    list of (params, cov, resid) and the frame of diagnostics of problems.
+    '''
+
+    results = [None] * len(design_matrices)
+    diagnostics = []
+    for indices, batch_design, batch_observations, batch_weights in stack_problems(design_matrices, observations, weights):
+        params, cov, resid, batch_diagnostics = huber_irls(
+            batch_design, batch_observations, batch_weights, tuning, tol, max_iterations
+        )
+        for batch_index, index in enumerate(indices):
+            rows = len(observations[index])
+            results[index] = (params[batch_index], cov[batch_index], resid[batch_index, :rows])
+        diagnostics.append(batch_diagnostics.set_index(pd.Index(indices)))
+
+    if not diagnostics:
+        return results, pd.DataFrame(columns=['iterations', 'converged', 'scale'])
+
+    diagnostics = pd.concat(diagnostics).sort_index()
+    not_converged = (~diagnostics.converged).sum()
+    if not_converged:
+        print(f'WARNING: {not_converged} of {len(diagnostics)} robust fits are not converged in {max_iterations} iterations')
+
+    return results, diagnostics
@@ -2,12 +2,116 @@
 Set of utilites for relative gravity processing
 '''
 
-from datetime import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import chain
+import io
+import os
 import re
+import numpy as np
 import pandas as pd
+from grav_proc.archives import is_zip_archive, open_data_file, zip_members
+from grav_proc.cache import cache_available, cache_key, load_cached, store_cached
+from grav_proc.resource import CG5_HEADER, CG6_HEADER
+
+# size of the file prefix to detect its format
+FORMAT_PREFIX_SIZE = 4096
+
+# version of the data file parsers, change it to invalidate the cached files
+PARSER_VERSION = 3
+
+CG6_DTYPES = {
+    'Instrument Serial Number': 'int',
+    'Gcal1 [mGal]': 'float',
+    'Goff [ADU]': 'float',
+    'Gref [mGal]': 'float',
+    'X Scale [arc-sec/ADU]': 'float',
+    'Y Scale [arc-sec/ADU]': 'float',
+    'X Offset [ADU]': 'float',
+    'Y Offset [ADU]': 'float',
+    'Temperature Coefficient [mGal/mK]': 'float',
+    'Temperature Scale [mK/ADU]': 'float',
+    'Drift Rate [mGal/day]': 'float',
+    'CorrGrav': 'float',
+    'Line': 'int',
+    'StdDev': 'float',
+    'StdErr': 'float',
+    'RawGrav': 'float',
+    'X': 'float',
+    'Y': 'float',
+    'SensorTemp': 'float',
+    'TideCorr': 'float',
+    'TiltCorr': 'float',
+    'TempCorr': 'float',
+    'DriftCorr': 'float',
+    'MeasurDur': 'int',
+    'InstrHeight': 'float',
+    'LatUser': 'float',
+    'LonUser': 'float',
+    'ElevUser': 'float',
+    'LatGPS': 'float',
+    'LonGPS': 'float',
+    'ElevGPS': 'float',
+}
+
+CG5_DTYPES = {
+    'Instrument S/N': 'int',
+    'ZONE': 'int',
+    'GMT DIFF.': 'float',
+    'Gref': 'float',
+    'Gcal1': 'float',
+    'TiltxS': 'float',
+    'TiltyS': 'float',
+    'TiltxO': 'float',
+    'TiltyO': 'float',
+    'Tempco': 'float',
+    'Drift': 'float',
+    # 'DriftTime Start': [],
+    # 'DriftDate Start': [],
+    # 'Tide Correction': [],
+    # 'Cont. Tilt': [],
+    # 'Auto Rejection': [],
+    # 'Terrain Corr.': [],
+    # 'Seismic Filter': [],
+    # 'Raw Data': [],
+    'LINE': 'int',
+    # 'STATION': [],
+    'ALT.': 'float',
+    'GRAV.': 'float',
+    'SD.': 'float',
+    'TILTX': 'float',
+    'TILTY': 'float',
+    'TEMP': 'float',
+    'TIDE': 'float',
+    'DUR': 'int',
+    'REJ': 'int',
+    # 'TIME': [],
+    # 'DEC.TIME+DATE': [],
+    'TERRAIN': 'float',
+    # 'DATE': [],
+}
+
+# CG-5 columns which are parsed from the text columns after loading
+CG5_TIME_COLUMNS = ['Created', 'Date_time']
+
+# numeric columns of CG-6 files with the text marker of missing values ('--' if there is no GPS fix)
+CG6_GPS_COLUMNS = ['LatGPS', 'LonGPS', 'ElevGPS']
+
+# raw columns of the parsed files which the where filters are applied to
+WHERE_COLUMNS = {
+    'cg5': {'lines': 'LINE', 'stations': 'STATION', 'meters': 'Instrument S/N'},
+    'cg6': {'lines': 'Line', 'stations': 'Station', 'meters': 'Instrument Serial Number'},
+}
+
+WHERE_KEYS = ['lines', 'stations', 'meters', 'time_range']
 
 def format_detect(data_file):
-    for line in data_file:
+    ''' Detect CG-x format by the first header line (a prefix of the file is read only) '''
+
+    head = data_file.read(FORMAT_PREFIX_SIZE)
+    data_file.seek(0)
+
+    for line in head.splitlines():
         line = line.strip()
         if not line or line == '/':
             continue
@@ -15,174 +119,365 @@ def format_detect(data_file):
             line = line[1:].strip()
             match line.split()[0]:
                 case 'CG-6':
-                    data_file.seek(0)
                     return 'cg6'
                 case 'CG-5':
-                    data_file.seek(0)
                     return 'cg5'
                 case _:
-                    data_file.seek(0)
                     return None
+    return None
+
+
+def detect_formats(data_files):
+    ''' Formats of data files, ImportError for the unknown one '''
+    formats = []
+    for data_file in data_files:
+        data_format = format_detect(data_file)
+        if data_format is None:
+            raise ImportError(f'{data_file.name} data file must be in CG-x format')
+        formats.append(data_format)
+    return formats
+
+
+def open_data_files(data_files):
+    ''' Open data files given by names, open files are passed as is
+
+    Compressed files are decompressed while reading, zip archives are
+    expanded to the members in CG-x format.
+    '''
+
+    opened = []
+    for data_file in data_files:
+        if not isinstance(data_file, (str, os.PathLike)):
+            opened.append(data_file)
+            continue
+        data_file_name = os.fspath(data_file)
+        if not is_zip_archive(data_file_name):
+            opened.append(open_data_file(data_file_name))
+            continue
+        for member_name in zip_members(data_file_name):
+            member = open_data_file(member_name)
+            if format_detect(member) is None:
+                member.close()
+                continue
+            opened.append(member)
+    return opened
+
+
+def read_data(data_files, jobs=1, cache_dir=None, columns=None, where=None):
+    ''' Load data from CG-x data files to one frame in CG-6 format
+
+    The format is detected for every file, so CG-5 and CG-6 files can be mixed.
+    Files can be given by names (see open_data_files). Only the columns are
+    loaded if given, readings are filtered by where (see select_readings)
+    while every file is parsed, before the type casting.
+    '''
+
+    check_where(where)
+    data_files = open_data_files(data_files)
+
+    if cache_dir is not None and not cache_available():
+        print('WARNING: pyarrow is not installed, the cache of parsed files is disabled')
+        cache_dir = None
+
+    formats = detect_formats(data_files)
+
+    if set(formats) == {'cg5'}:
+        cg_data = cg5_to_cg6_converter(
+            cg5_reader(data_files, jobs=jobs, cache_dir=cache_dir, where=where)
+        )
+        return cg_data if columns is None else cg_data[columns]
+    if set(formats) == {'cg6'}:
+        cg_data = cg6_reader(data_files, jobs=jobs, cache_dir=cache_dir, columns=columns, where=where)
+        return cg_data if columns is None else cg_data[columns]
+
+    file_readers = {'cg5': cg5_file_reader, 'cg6': cg6_parser(columns, where, cache_dir)}
+    parsed = read_files(
+        data_files,
+        [file_readers[data_format] for data_format in formats],
+        jobs,
+        cache_dir,
+        selects=[make_select(data_format, columns, where) for data_format in formats]
+    )
+
+    # the files of every format are typed together, then the frames are
+    # merged back in the order of the files
+    typed = {}
+    for data_format, types in [('cg5', cg5_types), ('cg6', cg6_types)]:
+        format_parsed = [cg_data for cg_data, cg_format in zip(parsed, formats) if cg_format == data_format]
+        cg_data = types(pd.concat(format_parsed, ignore_index=True))
+        if data_format == 'cg5':
+            cg_data = cg5_to_cg6_converter(cg_data)
+        bounds = np.cumsum([0] + [len(frame) for frame in format_parsed])
+        typed[data_format] = iter(
+            [cg_data.iloc[begin:end] for begin, end in zip(bounds[:-1], bounds[1:])]
+        )
+
+    cg_data = pd.concat(
+        [next(typed[data_format]) for data_format in formats],
+        ignore_index=True
+    )
+    return cg_data if columns is None else cg_data[columns]
+
+
+def check_where(where):
+    ''' ValueError for the unknown filter of readings '''
+    if where is None:
+        return
+    unknown = set(where) - set(WHERE_KEYS)
+    if unknown:
+        raise ValueError(f'Unknown filters of readings: {", ".join(sorted(unknown))}')
+
+
+def raw_date_time(cg_data, data_format):
+    ''' Times of readings of parsed (not typed) CG-x file '''
+    if data_format == 'cg5':
+        return cg5_datetime(cg_data['DATE'], cg_data['TIME'])
+    return pd.to_datetime(cg_data['Date'] + ' ' + cg_data['Time'], format='%Y-%m-%d %H:%M:%S')
+
+
+def select_readings(data_format, columns, where, cg_data):
+    ''' Filter readings and project columns of parsed (not typed) CG-x file
+
+    where is a dict of lists of lines, stations, meters (serial numbers) and
+    time_range (start, end) of readings, None values are not checked. The
+    stations are compared as they are in the frame of read_data. The columns
+    are the columns of read_data frame, CG-5 files are not projected since
+    all their columns are needed to convert them.
+    '''
+
+    if where:
+        where_columns = WHERE_COLUMNS[data_format]
+        mask = np.ones(len(cg_data), dtype=bool)
+        if where.get('lines') is not None:
+            lines = pd.to_numeric(cg_data[where_columns['lines']])
+            mask &= lines.isin(where['lines']).to_numpy()
+        if where.get('stations') is not None:
+            stations = cg_data[where_columns['stations']]
+            if data_format == 'cg5':
+                stations = cg5_station(stations)
+            mask &= stations.astype(str).isin([str(station) for station in where['stations']]).to_numpy()
+        if where.get('meters') is not None:
+            meters = pd.to_numeric(cg_data[where_columns['meters']])
+            mask &= meters.isin(where['meters']).to_numpy()
+        if where.get('time_range') is not None:
+            start, end = where['time_range']
+            date_time = raw_date_time(cg_data, data_format)
+            if start is not None:
+                mask &= (date_time >= pd.Timestamp(start)).to_numpy()
+            if end is not None:
+                mask &= (date_time <= pd.Timestamp(end)).to_numpy()
+        cg_data = cg_data[mask].reset_index(drop=True)
+
+    if columns is not None and data_format == 'cg6':
+        raw_columns = [column for column in columns if column in cg_data.columns]
+        # the time columns are parsed from the dates and times
+        if 'date_time' in columns or 'date_days' in columns:
+            raw_columns += [column for column in ['Date', 'Time'] if column not in raw_columns]
+        cg_data = cg_data[raw_columns]
+
+    return cg_data
+
+
+def parsed_columns(columns=None, where=None):
+    ''' Readings columns of CG-6 file to parse for the columns and where filters, None for all '''
+    if columns is None:
+        return None
+    usecols = set(columns)
+    # the time columns are parsed from the dates and times
+    if {'date_time', 'date_days'} & usecols or (where and where.get('time_range') is not None):
+        usecols |= {'Date', 'Time'}
+    for key in ['lines', 'stations']:
+        if where and where.get(key) is not None:
+            usecols.add(WHERE_COLUMNS['cg6'][key])
+    return usecols
+
+
+def cg6_parser(columns=None, where=None, cache_dir=None):
+    ''' Parser of CG-6 files for read_files
+
+    The cache keeps the whole parsed files, so all columns are parsed with
+    the cache, the needed ones only (see parsed_columns) otherwise.
+    '''
+    usecols = parsed_columns(columns, where)
+    if cache_dir is not None or usecols is None:
+        return cg6_file_reader
+    return partial(cg6_file_reader, usecols=usecols)
 
 
-def read_data(data_files):
-    ''' Load data from CG-6 data file'''
+def make_select(data_format, columns=None, where=None):
+    ''' Selection of parsed file for read_files or None if nothing is selected '''
+    if columns is None and not where:
+        return None
+    return partial(select_readings, data_format, columns, where)
 
-    match format_detect(data_files[0]):
-        case 'cg5':
-            return cg5_to_cg6_converter(cg5_reader(data_files))
-        case 'cg6':
-            return cg6_reader(data_files)
-        case _:
-            raise ImportError(f'{data_files[0].name} data file must be in CG-x format')
 
+def open_and_read(file_reader, data_file_name):
+    ''' Open data file by name and parse it (process pool worker) '''
+    return file_reader(open_data_file(data_file_name))
 
-def cg5_reader(data_files):
+
+def cached_file_reader(file_reader, cache_dir, data_file):
+    ''' Get parsed data file from the cache, parse and store it on miss '''
+
+    key = cache_key(data_file.name, f'{file_reader.__name__}-{PARSER_VERSION}')
+    cg_data = load_cached(cache_dir, key)
+    if cg_data is None:
+        cg_data = file_reader(data_file)
+        store_cached(cache_dir, key, cg_data)
+    else:
+        data_file.close()
+        # the same content can be cached from a file with other name
+        cg_data['DataFile'] = data_file.name
+    return cg_data
+
+
+def selected_file_reader(file_reader, select, data_file):
+    ''' Parse data file and select its readings '''
+    return select(file_reader(data_file))
+
+
+def read_files(data_files, file_readers, jobs=1, cache_dir=None, selects=None):
+    ''' Parse data files in given order, in process pool if jobs > 1
+
+    file_readers is one parser for all files or the list of parsers by files,
+    so are selects (see make_select) applied to the parsed files. The cache
+    keeps the whole parsed files, they are selected after loading.
+    '''
+
+    if callable(file_readers):
+        file_readers = [file_readers] * len(data_files)
+    if selects is None or callable(selects):
+        selects = [selects] * len(data_files)
+
+    if cache_dir is not None:
+        file_readers = [
+            partial(cached_file_reader, file_reader, cache_dir) for file_reader in file_readers
+        ]
+
+    file_readers = [
+        file_reader if select is None else partial(selected_file_reader, file_reader, select)
+        for file_reader, select in zip(file_readers, selects)
+    ]
+
+    if jobs is None or jobs <= 1 or len(data_files) < 2:
+        return [
+            file_reader(data_file) for file_reader, data_file in zip(file_readers, data_files)
+        ]
+
+    # open files can not be sent to the workers, so they get the names only
+    data_file_names = []
+    for data_file in data_files:
+        data_file_names.append(data_file.name)
+        data_file.close()
+
+    jobs = min(jobs, len(data_files))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(open_and_read, file_readers, data_file_names))
+
+
+def iter_cg5_rows(data_file):
+    ''' Iterate over readings of CG-5 data file
+
+    The same dict is updated and yielded for every reading, so its values
+    have to be copied before the next step.
+    '''
 
     meter_type = 'cg5'
 
-    rows = {
-        'Survey name': [],
-        'Instrument S/N': [],
-        'Client': [],
-        'Operator': [],
-        'Date': [],
-        'Time': [],
-        'LONG': [],
-        'LAT': [],
-        'ZONE': [],
-        'GMT DIFF.': [],
-        'Gref': [],
-        'Gcal1': [],
-        'TiltxS': [],
-        'TiltyS': [],
-        'TiltxO': [],
-        'TiltyO': [],
-        'Tempco': [],
-        'Drift': [],
-        'DriftTime Start': [],
-        'DriftDate Start': [],
-        'Tide Correction': [],
-        'Cont. Tilt': [],
-        'Auto Rejection': [],
-        'Terrain Corr.': [],
-        'Seismic Filter': [],
-        'Raw Data': [],
-        'LINE': [],
-        'STATION': [],
-        'ALT.': [],
-        'GRAV.': [],
-        'SD.': [],
-        'TILTX': [],
-        'TILTY': [],
-        'TEMP': [],
-        'TIDE': [],
-        'DUR': [],
-        'REJ': [],
-        'TIME': [],
-        'DEC.TIME+DATE': [],
-        'TERRAIN': [],
-        'DATE': [],
-        'MeterType': [],
-        'DataFile': [],
-        'Created': [],
-        'Date_time': []
-    }
+    line_station_format = False
+
+    row = {}
+    for line in data_file:
+        if not line.strip():
+            continue
+        match line[:2].strip():
+            case '/':
+                split_line = re.split(':', line[1:])
+                for index in range(len(split_line)):
+                    split_line[index] = split_line[index].strip()
+                if len(split_line) > 1:
+                    row.update({split_line[0]: ' '.join(x for x in split_line[1:])})
+            case '/-':
+                line = line[1:].replace('-', ' ')
+                headers = line.split()
+            case 'Li':
+                line_station_format = True
+            case _:
+                split_line = line.split()
+                for index in range(len(split_line)):
+                    row.update({headers[index]: split_line[index]})
+                row.update({'MeterType': meter_type.upper()})
+                row.update({'DataFile': data_file.name})
+
+                yield row
+
+    data_file.close()
+
+
+def cg5_file_reader(data_file):
+    ''' Parse one CG-5 data file '''
+
+    rows = {key: [] for key in CG5_HEADER if key not in CG5_TIME_COLUMNS}
+
+    for row in iter_cg5_rows(data_file):
+        for key, value in row.items():
+            rows[key].append(value)
+
+    return pd.DataFrame(rows)
+
+
+def cg5_reader(data_files, jobs=1, cache_dir=None, where=None):
+
+    meter_type = 'cg5'
 
     for data_file in data_files:
         if format_detect(data_file) != meter_type:
             raise ImportError(f'{data_file.name} data file must be in {meter_type.upper()} format')
-        
-        lines = data_file.readlines()
-        data_file.close()
 
-        line_station_format = False
+    cg_data = pd.concat(
+        read_files(data_files, cg5_file_reader, jobs, cache_dir, make_select(meter_type, where=where)),
+        ignore_index=True
+    )
 
-        row = {}
-        for line in lines:
-            if not line.strip():
-                continue
-            match line[:2].strip():
-                case '/':
-                    split_line = re.split(':', line[1:])
-                    for index in range(len(split_line)):
-                        split_line[index] = split_line[index].strip()
-                    if len(split_line) > 1:
-                        row.update({split_line[0]: ' '.join(x for x in split_line[1:])})
-                case '/-':
-                    line = line[1:].replace('-', ' ')
-                    headers = line.split()
-                case 'Li':
-                    line_station_format = True
-                case _:
-                    split_line = line.split()
-                    for index in range(len(split_line)):
-                        row.update({headers[index]: split_line[index]})
-                    row.update({'MeterType': meter_type.upper()})
-                    row.update({'DataFile': data_file.name})
-                    created = dt.strptime(' '.join(row['Date'].split('/')+row['Time'].split(':')), '%Y %m %d %H %M %S')
-                    date_time = dt.strptime(' '.join(row['DATE'].split('/')+row['TIME'].split(':')), '%Y %m %d %H %M %S')
-                    row.update({'Created': created})
-                    row.update({'Date_time': date_time})
-                   
-                    for key, value in row.items():
-                        rows[key].append(value)
-   
-    cg_data = pd.DataFrame(rows)
-
-    cg_data = cg_data.astype(
-        {
-            'Instrument S/N': 'int',
-            'ZONE': 'int',
-            'GMT DIFF.': 'float',
-            'Gref': 'float',
-            'Gcal1': 'float',
-            'TiltxS': 'float',
-            'TiltyS': 'float',
-            'TiltxO': 'float',
-            'TiltyO': 'float',
-            'Tempco': 'float',
-            'Drift': 'float',
-            # 'DriftTime Start': [],
-            # 'DriftDate Start': [],
-            # 'Tide Correction': [],
-            # 'Cont. Tilt': [],
-            # 'Auto Rejection': [],
-            # 'Terrain Corr.': [],
-            # 'Seismic Filter': [],
-            # 'Raw Data': [],
-            'LINE': 'int',
-            # 'STATION': [],
-            'ALT.': 'float',
-            'GRAV.': 'float',
-            'SD.': 'float',
-            'TILTX': 'float',
-            'TILTY': 'float',
-            'TEMP': 'float',
-            'TIDE': 'float',
-            'DUR': 'int',
-            'REJ': 'int',
-            # 'TIME': [],
-            # 'DEC.TIME+DATE': [],
-            'TERRAIN': 'float',
-            # 'DATE': [],
-        }, errors='ignore'
+    return cg5_types(cg_data)
+
+
+def epoch_days(date_time):
+    ''' Days since the Unix epoch for the column of times (as to_days of every value) '''
+    return (date_time - pd.Timestamp(0)).dt.total_seconds() / 60 / 60 / 24
+
+
+def cg5_datetime(date, time):
+    ''' Parse columns of CG-5 dates (2022/ 4/11) and times (06:39:50) '''
+    return pd.to_datetime(
+        (date + ' ' + time).str.replace('/', ' ').str.replace(':', ' '),
+        format='%Y %m %d %H %M %S'
     )
 
-    # cg_data['Created'] = cg_data.apply(
-        # lambda x: dt.strptime(' '.join(x['Date'].split('/')+x['Time'].split(':')), '%Y %m %d %H %M %S'), axis=1)
 
-    # cg_data['Date_time'] = cg_data.apply(
-        # lambda x: dt.strptime(' '.join(x['DATE'].split('/')+x['TIME'].split(':')), '%Y %m %d %H %M %S'), axis=1)
+def cg5_station(station):
+    ''' CG-6 station names of CG-5 stations (14.0000000 to 14.0) '''
+    return station.astype(float).astype(str)
+
+
+def cg5_types(cg_data):
+    ''' Cast columns of CG-5 frame to their types and add the time columns '''
+
+    cg_data = cg_data.astype(CG5_DTYPES, errors='ignore')
+
+    cg_data['Created'] = cg5_datetime(cg_data['Date'], cg_data['Time'])
+    cg_data['Date_time'] = cg5_datetime(cg_data['DATE'], cg_data['TIME'])
 
     return cg_data
 
+
 def std_dev_to_std_err(std_dev, dur, rej):
-    num = dur - rej
-    if num <= 0:
-        return std_dev
-    return std_dev / num**0.5
-    
+    ''' Standard error of the mean of dur - rej samples (arrays are welcome) '''
+    num = np.asarray(dur - rej)
+    std_dev = np.asarray(std_dev)
+    # StdDev is kept if there is no accepted samples
+    return np.where(num > 0, std_dev / np.where(num > 0, num, 1)**0.5, std_dev)
+
 
 def cg5_to_cg6_converter(cg5_data):
 
@@ -203,15 +498,18 @@ def cg5_to_cg6_converter(cg5_data):
     cg6_data['Temperature Coefficient [mGal/mK]'] = None
     cg6_data['Temperature Scale [mK/ADU]'] = None
     cg6_data['Drift Rate [mGal/day]'] = cg5_data['Drift']
-    cg6_data['Drift Zero Time'] = cg5_data.apply(lambda x: dt.strptime(' '.join([x['DriftDate Start'], x['DriftTime Start']]), '%Y/%m/%d %H %M %S'), axis=1)
+    cg6_data['Drift Zero Time'] = pd.to_datetime(
+        cg5_data['DriftDate Start'] + ' ' + cg5_data['DriftTime Start'],
+        format='%Y/%m/%d %H %M %S'
+    )
     cg6_data['Firmware Version'] = None
-    cg6_data['Station'] = cg5_data['STATION'].astype(float).astype(str)
+    cg6_data['Station'] = cg5_station(cg5_data['STATION'])
     cg6_data['Date'] = cg5_data['DATE']
     cg6_data['Time'] = cg5_data['TIME']
     cg6_data['CorrGrav'] = cg5_data['GRAV.']
     cg6_data['Line'] = cg5_data['LINE'].astype('float').astype('int')
     cg6_data['StdDev'] = cg5_data['SD.']
-    cg6_data['StdErr'] = cg5_data.apply(lambda x: std_dev_to_std_err(x['SD.'], x['DUR'], x['REJ']), axis=1)
+    cg6_data['StdErr'] = std_dev_to_std_err(cg5_data['SD.'], cg5_data['DUR'], cg5_data['REJ'])
     cg6_data['RawGrav'] = None
     cg6_data['X'] = cg5_data['TILTX']
     cg6_data['Y'] = cg5_data['TILTY']
@@ -232,142 +530,288 @@ def cg5_to_cg6_converter(cg5_data):
     cg6_data['MeterType'] = cg5_data['MeterType']
     cg6_data['DataFile'] = cg5_data['DataFile']
     cg6_data['date_time'] = cg5_data['Date_time']
+    cg6_data['date_days'] = epoch_days(cg6_data['date_time'])
     
     return cg6_data
 
-def cg6_reader(data_files):
+def read_block(text, headers, dtypes, usecols=None):
+    ''' Parse block of whitespace separated readings by one call '''
+    return pd.read_csv(
+        io.StringIO(text),
+        sep=r'\s+',
+        header=None,
+        names=headers,
+        usecols=usecols,
+        dtype=dtypes,
+        na_filter=False,
+    )
+
+
+def cg6_block(text, headers, row, data_file_name, usecols=None):
+    ''' Make frame of CG-6 readings block (text) with the header values of the block
+
+    Only the readings columns of usecols are parsed if given (see
+    parsed_columns), the others are left empty.
+    '''
+
+    meter_type = 'cg6'
+
+    usecols = None if usecols is None else [header for header in headers if header in usecols]
+    # the values are kept as text, the columns of all files are cast once by
+    # cg6_types, so a malformed value keeps its column text in every file
+    block = read_block(text, headers, str, usecols)
+    block = block.assign(**row)
+    block['MeterType'] = meter_type.upper()
+    block['DataFile'] = data_file_name
+    return block.reindex(columns=CG6_HEADER)
+
+
+def check_cg6_headers(headers, data_file_name):
+    ''' ImportError for the readings of CG-6 file before its column header line (/Station ...) '''
+    if not headers:
+        raise ImportError(f'{data_file_name} data file has readings before the column header line (/Station Date Time ...)')
+
+
+def carry_short_rows(readings, last=None):
+    ''' Fill the fields missing at the end of short rows by the previous reading
+
+    The parsed fields are text, the missing ones are empty. The values are
+    carried from the previous reading of the file (the last one is the
+    reading before the readings), as the line by line parser did.
+    '''
+
+    missing = readings == ''
+    columns = readings.columns[missing.any()]
+    if not len(columns):
+        return readings
+    filled = readings[columns].mask(missing[columns])
+    if last is not None:
+        filled = pd.concat([last[columns].to_frame().T, filled]).ffill().iloc[1:]
+    readings = readings.copy()
+    readings[columns] = filled.ffill().fillna('')
+    return readings
+
+
+def update_cg6_header(line, row, headers):
+    ''' Update header values (row) or readings headers by the '/' line '''
+    match line[:2].strip():
+        case '/':
+            split_line = [item.strip() for item in re.split(':', line[1:])]
+            if len(split_line) > 1:
+                row.update({split_line[0]: ' '.join(split_line[1:])})
+        case '/S':
+            headers[:] = line[1:].split()
+
+
+def cg6_file_reader(data_file, usecols=None):
+    ''' Parse one CG-6 data file: headers line by line, readings in bulk
+
+    Only the readings columns of usecols are parsed if given (see cg6_block).
+    '''
+
+    text = data_file.read()
+    data_file.close()
+
+    row = {}
+    headers = []
+    blocks = []
+    position = 0
+    size = len(text)
+    while position < size:
+        end = text.find('\n', position)
+        end = size if end < 0 else end + 1
+        line = text[position:end]
+        if not line.strip():
+            position = end
+        elif line[:2].strip() in ('/', '/S'):
+            update_cg6_header(line, row, headers)
+            position = end
+        else:
+            check_cg6_headers(headers, data_file.name)
+            # all readings up to the next header line are parsed at once
+            stop = text.find('\n/', position)
+            stop = size if stop < 0 else stop + 1
+            blocks.append(cg6_block(text[position:stop], headers, row, data_file.name, usecols))
+            position = stop
+
+    if not blocks:
+        return pd.DataFrame(columns=CG6_HEADER)
+
+    return carry_short_rows(pd.concat(blocks, ignore_index=True))
+
+
+def fixed_types(cg_data, dtypes):
+    ''' Cast columns of parsed frame to dtypes whatever their values are
+
+    The columns are converted by to_numeric, the malformed values are NaN
+    then (they are counted in the warning). The int columns are float if
+    they have NaN or fractions.
+    '''
+
+    for column, dtype in dtypes.items():
+        if column not in cg_data.columns:
+            continue
+        values = pd.to_numeric(cg_data[column], errors='coerce').astype(float)
+        malformed = int(values.isna().sum() - cg_data[column].isna().sum())
+        if malformed:
+            print(f'WARNING: {malformed} malformed values of {column} are read as NaN')
+        if dtype == 'int' and np.all(np.mod(values.to_numpy(), 1) == 0):
+            values = values.astype(dtype)
+        cg_data[column] = values
+    return cg_data
+
+
+def cg6_types(cg_data, fixed=False):
+    ''' Cast columns of CG-6 frame to their types (the columns of projected frame only)
+
+    The columns with malformed values are left as text. With fixed the
+    types do not depend on the values (the schema of chunks, see
+    iter_cg6_chunks): the GPS columns stay text, the malformed values of
+    other columns are NaN.
+    '''
+
+    dtypes = {column: dtype for column, dtype in CG6_DTYPES.items() if column in cg_data.columns}
+    if fixed:
+        cg_data = fixed_types(
+            cg_data, {column: dtype for column, dtype in dtypes.items() if column not in CG6_GPS_COLUMNS}
+        )
+    else:
+        cg_data = cg_data.astype(dtypes, errors='ignore')
+
+    for column in ['Created', 'Drift Zero Time']:
+        if column in cg_data.columns:
+            cg_data[column] = pd.to_datetime(
+                cg_data[column],
+                format='%Y-%m-%d %H %M %S',
+            )
+
+    if 'Date' in cg_data.columns and 'Time' in cg_data.columns:
+        cg_data['date_time'] = pd.to_datetime(
+            cg_data['Date'] + ' ' + cg_data['Time'],
+            format='%Y-%m-%d %H:%M:%S'
+        )
+        cg_data['date_days'] = epoch_days(cg_data['date_time'])
+
+    return cg_data
+
+
+def cg6_reader(data_files, jobs=1, cache_dir=None, columns=None, where=None):
     meter_type = 'cg6'
-    rows = {
-        'Survey Name': [],
-        'Instrument Serial Number': [],
-        'Created': [],
-        'Operator': [],
-        'Gcal1 [mGal]': [],
-        'Goff [ADU]': [],
-        'Gref [mGal]': [],
-        'X Scale [arc-sec/ADU]': [],
-        'Y Scale [arc-sec/ADU]': [],
-        'X Offset [ADU]': [],
-        'Y Offset [ADU]': [],
-        'Temperature Coefficient [mGal/mK]': [],
-        'Temperature Scale [mK/ADU]': [],
-        'Drift Rate [mGal/day]': [],
-        'Drift Zero Time': [],
-        'Firmware Version': [],
-        'Station': [],
-        'Date': [],
-        'Time': [],
-        'CorrGrav': [],
-        'Line': [],
-        'StdDev': [],
-        'StdErr': [],
-        'RawGrav': [],
-        'X': [],
-        'Y': [],
-        'SensorTemp': [],
-        'TideCorr': [],
-        'TiltCorr': [],
-        'TempCorr': [],
-        'DriftCorr': [],
-        'MeasurDur': [],
-        'InstrHeight': [],
-        'LatUser': [],
-        'LonUser': [],
-        'ElevUser': [],
-        'LatGPS': [],
-        'LonGPS': [],
-        'ElevGPS': [],
-        'Corrections[drift-temp-na-tide-tilt]': [],
-        'MeterType': [],
-        'DataFile': [],
-    }
 
     for data_file in data_files:
         if format_detect(data_file) != meter_type:
             raise ImportError(f'{data_file.name} data file must be in {meter_type.upper()} format')
 
-        lines = data_file.readlines()
-        data_file.close()
-            
+    cg_data = pd.concat(
+        read_files(data_files, cg6_parser(columns, where, cache_dir), jobs, cache_dir, make_select(meter_type, columns, where)),
+        ignore_index=True
+    )
+
+    return cg6_types(cg_data)
+
+
+def iter_cg6_chunks(data_files, chunk_rows=100000, columns=None, where=None):
+    ''' Iterate over typed frames of at most chunk_rows CG-6 readings
+
+    Files are read line by line, so the memory is bounded by the chunk size.
+    The header values (and the fields of short rows, see carry_short_rows)
+    are carried over the chunk boundaries and the index runs through all
+    chunks as in the frame of cg6_reader. Chunks are selected as the files
+    of read_data, so they can be shorter.
+
+    Every chunk has the same types (see cg6_types with fixed): the GPS
+    columns are text and the malformed numbers are NaN. The frame of
+    read_data keeps the column text if it can not be cast, so the chunks
+    differ from it there.
+    '''
+
+    meter_type = 'cg6'
+    select = make_select(meter_type, columns, where) or (lambda cg_data: cg_data)
+    usecols = parsed_columns(columns, where)
+
+    offset = 0
+    for data_file in data_files:
+        if format_detect(data_file) != meter_type:
+            raise ImportError(f'{data_file.name} data file must be in {meter_type.upper()} format')
+
         row = {}
-        for line in lines:
+        headers = []
+        lines = []
+        last = None
+        # the last '/' line flushes the rest of readings
+        for line in chain(data_file, ['/']):
             if not line.strip():
                 continue
-            match line[:2].strip():
-                case '/':
-                    split_line = re.split(':', line[1:])
-                    for index in range(len(split_line)):
-                        split_line[index] = split_line[index].strip()
-                    if len(split_line) > 1:
-                        row.update({split_line[0]: ' '.join(x for x in split_line[1:])})
-                case '/S':
-                    line = line[1:]
-                    headers = line.split()
-                case _:
-                    split_line = line.split()
-                    for index in range(len(split_line)):
-                        row.update({headers[index]: split_line[index]})
-                    row.update({'MeterType': meter_type.upper()})
-                    row.update({'DataFile': data_file.name})
-                    
-                    for key, value in row.items():
-                        rows[key].append(value)    
-
-    cg_data = pd.DataFrame(rows)        
-
-    cg_data = cg_data.astype(
-        {
-            'Instrument Serial Number': 'int',
-            'Gcal1 [mGal]': 'float',
-            'Goff [ADU]': 'float',
-            'Gref [mGal]': 'float',
-            'X Scale [arc-sec/ADU]': 'float',
-            'Y Scale [arc-sec/ADU]': 'float',
-            'X Offset [ADU]': 'float',
-            'Y Offset [ADU]': 'float',
-            'Temperature Coefficient [mGal/mK]': 'float',
-            'Temperature Scale [mK/ADU]': 'float',
-            'Drift Rate [mGal/day]': 'float',
-            'CorrGrav': 'float',
-            'Line': 'int',
-            'StdDev': 'float',
-            'StdErr': 'float',
-            'RawGrav': 'float',
-            'X': 'float',
-            'Y': 'float',
-            'SensorTemp': 'float',
-            'TideCorr': 'float',
-            'TiltCorr': 'float',
-            'TempCorr': 'float',
-            'DriftCorr': 'float',
-            'MeasurDur': 'int',
-            'InstrHeight': 'float',
-            'LatUser': 'float',
-            'LonUser': 'float',
-            'ElevUser': 'float',
-            'LatGPS': 'float',
-            'LonGPS': 'float',
-            'ElevGPS': 'float',
-        },
-        errors='ignore'
-    )
+            header_line = line[:2].strip() in ('/', '/S')
+            if not header_line and len(lines) < chunk_rows:
+                lines.append(line)
+                continue
+            if lines:
+                check_cg6_headers(headers, data_file.name)
+                block = carry_short_rows(cg6_block(''.join(lines), headers, row, data_file.name, usecols), last)
+                last = block.iloc[-1]
+                chunk = cg6_types(select(block), fixed=True)
+                if columns is not None:
+                    chunk = chunk[columns]
+                chunk.index += offset
+                offset += len(chunk)
+                lines = []
+                yield chunk
+            if header_line:
+                update_cg6_header(line, row, headers)
+            else:
+                lines.append(line)
+        data_file.close()
 
-    cg_data['Created'] = pd.to_datetime(
-        cg_data['Created'],
-        format='%Y-%m-%d %H %M %S',
-    )
 
-    cg_data['Drift Zero Time'] = pd.to_datetime(
-        cg_data['Drift Zero Time'],
-        format='%Y-%m-%d %H %M %S'
-    )
+def iter_cg5_chunks(data_files, chunk_rows=100000, columns=None, where=None):
+    ''' Iterate over frames of at most chunk_rows CG-5 readings converted to CG-6 format
 
-    cg_data['date_time'] = cg_data.apply(
-        lambda x: dt.strptime('{d} {t}'.format(d=x['Date'], t=x['Time']), '%Y-%m-%d %H:%M:%S'),
-        axis=1
-    )
+    The chunks have the same types, the malformed numbers are NaN (see fixed_types).
+    '''
 
-    return cg_data
+    meter_type = 'cg5'
+    select = make_select(meter_type, where=where) or (lambda cg_data: cg_data)
+
+    offset = 0
+    for data_file in data_files:
+        if format_detect(data_file) != meter_type:
+            raise ImportError(f'{data_file.name} data file must be in {meter_type.upper()} format')
+
+        rows = {key: [] for key in CG5_HEADER if key not in CG5_TIME_COLUMNS}
+        count = 0
+        for row in chain(iter_cg5_rows(data_file), [None]):
+            if row is not None:
+                for key, value in row.items():
+                    rows[key].append(value)
+                count += 1
+            if count and (row is None or count == chunk_rows):
+                chunk = cg5_to_cg6_converter(cg5_types(fixed_types(select(pd.DataFrame(rows)), CG5_DTYPES)))
+                if columns is not None:
+                    chunk = chunk[columns]
+                chunk.index += offset
+                offset += len(chunk)
+                rows = {key: [] for key in CG5_HEADER if key not in CG5_TIME_COLUMNS}
+                count = 0
+                yield chunk
+
+
+def iter_data_chunks(data_files, chunk_rows=100000, columns=None, where=None):
+    ''' Iterate over chunks of CG-x data files in CG-6 format (see read_data) '''
+
+    check_where(where)
+    file_iterators = {'cg5': iter_cg5_chunks, 'cg6': iter_cg6_chunks}
+    data_files = open_data_files(data_files)
+    formats = detect_formats(data_files)
+
+    offset = 0
+    for data_file, data_format in zip(data_files, formats):
+        file_rows = 0
+        for chunk in file_iterators[data_format]([data_file], chunk_rows, columns, where):
+            file_rows += len(chunk)
+            chunk.index += offset
+            yield chunk
+        offset += file_rows
 
 def read_scale_factors(calibration_files):
     
@@ -201,9 +201,9 @@ def residuals_plot(raw_data):
     fig.supylabel('Residuals [uGal]')
     fig.supxlabel('Date Time')
 
-    for meter_created, grouped in raw_data.groupby(['instrument_serial_number', 'created']):
+    for meter_created, grouped in raw_data.groupby(['instrument_serial_number', 'created'], observed=True):
         meter, created = meter_created
-        for station, grouped_by_station in grouped.groupby('station'):
+        for station, grouped_by_station in grouped.groupby('station', observed=True):
             if len(meters) > 1:
                 ax[meter_number[meter]].set_title(f'CG-6 #{meter}', loc='left')
                 ax[meter_number[meter]].plot(grouped_by_station['date_time'], grouped_by_station['resid'], '.', label=station)
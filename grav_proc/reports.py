@@ -3,7 +3,8 @@ import pandas as pd
 from grav_proc.calculations import get_ties_sum
 
 
-def get_report(ties):
+def get_report(ties, cycles_mode='auto', max_cycles=None, max_length=None):
+    ''' Report of mean ties and sums of ties along the cycles (see get_ties_sum) '''
     columns = [
         'station_from',             # *
         'station_to',               # *
@@ -45,7 +46,7 @@ def get_report(ties):
     group_by_meters = ties.groupby('instrument_serial_number')
 
     for meter, meter_ties in group_by_meters:
-        meter_ties_sums = get_ties_sum(meter_ties)
+        meter_ties_sums = get_ties_sum(meter_ties, cycles_mode, max_cycles, max_length)
         if len(meter_ties_sums):
             ties_sums = pd.concat([ties_sums, meter_ties_sums])
     if len(ties_sums):
@@ -44,4 +44,49 @@ CG5_HEADER = [
     'DataFile',
     'Created',
     'Date_time',
-]
\ No newline at end of file
+]
+
+CG6_HEADER = [
+    'Survey Name',
+    'Instrument Serial Number',
+    'Created',
+    'Operator',
+    'Gcal1 [mGal]',
+    'Goff [ADU]',
+    'Gref [mGal]',
+    'X Scale [arc-sec/ADU]',
+    'Y Scale [arc-sec/ADU]',
+    'X Offset [ADU]',
+    'Y Offset [ADU]',
+    'Temperature Coefficient [mGal/mK]',
+    'Temperature Scale [mK/ADU]',
+    'Drift Rate [mGal/day]',
+    'Drift Zero Time',
+    'Firmware Version',
+    'Station',
+    'Date',
+    'Time',
+    'CorrGrav',
+    'Line',
+    'StdDev',
+    'StdErr',
+    'RawGrav',
+    'X',
+    'Y',
+    'SensorTemp',
+    'TideCorr',
+    'TiltCorr',
+    'TempCorr',
+    'DriftCorr',
+    'MeasurDur',
+    'InstrHeight',
+    'LatUser',
+    'LonUser',
+    'ElevUser',
+    'LatGPS',
+    'LonGPS',
+    'ElevGPS',
+    'Corrections[drift-temp-na-tide-tilt]',
+    'MeterType',
+    'DataFile',
+]
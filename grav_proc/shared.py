@@ -0,0 +1,62 @@
+'''
+Numeric columns in shared memory for worker processes
+'''
+
+from multiprocessing import shared_memory
+import numpy as np
+
+# alignment of the columns in the shared block, bytes
+COLUMN_ALIGNMENT = 64
+
+# the blocks attached by the worker process, by name
+ATTACHED_BLOCKS = {}
+
+
+def share_columns(columns):
+    ''' Copy the dict of 1-d arrays to the new shared memory block
+
+    Returns the block and its layout: the name of block and (name, dtype,
+    offset, length) of every column. The layout is sent to workers instead
+    of the arrays, the caller closes and unlinks the block after the pool.
+    '''
+
+    arrays = {name: np.ascontiguousarray(values) for name, values in columns.items()}
+    specs = []
+    size = 0
+    for name, values in arrays.items():
+        specs.append((name, values.dtype.str, size, len(values)))
+        size += -(-values.nbytes // COLUMN_ALIGNMENT) * COLUMN_ALIGNMENT
+
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for name, dtype, offset, length in specs:
+        np.ndarray(length, dtype=dtype, buffer=block.buf, offset=offset)[:] = arrays[name]
+
+    return block, (block.name, specs)
+
+
+def column_views(block, layout):
+    ''' Arrays of the columns of shared block, they are views of its buffer '''
+    _, specs = layout
+    return {
+        name: np.ndarray(length, dtype=dtype, buffer=block.buf, offset=offset)
+        for name, dtype, offset, length in specs
+    }
+
+
+def read_column(block, layout, name):
+    ''' Copy of the column, so the block can be closed '''
+    return column_views(block, layout)[name].copy()
+
+
+def attach_columns(layout):
+    ''' Views of the columns of shared block in worker process
+
+    The block is attached once per process and stays mapped until its exit,
+    the views of the columns are valid while the parent keeps the block.
+    '''
+
+    name, _ = layout
+    if name not in ATTACHED_BLOCKS:
+        ATTACHED_BLOCKS[name] = shared_memory.SharedMemory(name=name)
+
+    return column_views(ATTACHED_BLOCKS[name], layout)
@@ -1,8 +1,41 @@
 import numpy as np
 import pandas as pd
 import statsmodels.api as sm
+from scipy import sparse
+from grav_proc.least_squares import best_terms, nested_lstsq, robust_fits, station_design
 
-def get_vg(readings, max_degree=2, vg_max_degree=2):
+
+def rlm_fits(design_matrices, observations, backend='numpy'):
+    ''' Robust fits of the list of problems as (params, bse, cov, resid)
+
+    The numpy backend stacks the problems to huber_irls, the statsmodels
+    backend fits sm.RLM one by one as the reference.
+    '''
+
+    match backend:
+        case 'numpy':
+            solutions, _ = robust_fits(design_matrices, observations)
+            return [
+                (params, np.sqrt(np.diagonal(cov)), cov, resid) for params, cov, resid in solutions
+            ]
+        case 'statsmodels':
+            results = [
+                sm.RLM(observation, design_matrix.toarray() if sparse.issparse(design_matrix) else design_matrix).fit()
+                for design_matrix, observation in zip(design_matrices, observations)
+            ]
+            return [
+                (result.params, result.bse, result.cov_params(), result.resid) for result in results
+            ]
+
+
+def line_ties(readings, max_degree=2, backend='numpy', criterion=None):
+    ''' Ties from the first station of every line with the drift of the line
+
+    The fits of all lines are solved together by rlm_fits. With criterion
+    (aic or bic) the degree of drift of every line from 0 to
+    max_degree is chosen by the WLS fits of nested_lstsq, the drift is of
+    days since the first reading of line then.
+    '''
 
     ties_dict = {
         'meter': [],
@@ -23,67 +56,86 @@ def get_vg(readings, max_degree=2, vg_max_degree=2):
         'operator': [],
    }
 
-    group_by_meter_and_survey = readings.groupby(['instrument_serial_number', 'survey_name'])
+    lines = []
+    design_matrices = []
+    observations = []
+
+    group_by_meter_and_survey = readings.groupby(['instrument_serial_number', 'survey_name'], observed=True)
     for meter_survey, grouped_by_meter_and_survey in group_by_meter_and_survey:
         meter, survey = meter_survey
         group_by_line = grouped_by_meter_and_survey.groupby('line')
         for line, grouped_by_line in group_by_line:
-            grav = np.vstack(grouped_by_line.corr_grav)
-            date_time = np.array(grouped_by_line.date_time.apply(lambda x: x.timestamp()/86400))
-            drift_design = np.vander(date_time, max_degree + 1)
+            grav = grouped_by_line.corr_grav.to_numpy(dtype=float)
+            date_time = grouped_by_line.date_days.to_numpy()
+            if criterion is None:
+                drift_design = np.vander(date_time, max_degree + 1)
+            else:
+                drift_design = np.vander(date_time - date_time[0], max_degree + 1, increasing=True)
             change_stations = grouped_by_line.station.unique()
             change_heights = grouped_by_line.instr_height.unique()
             fix_station = change_stations[0]
             fix_height = change_heights[0]
             change_stations = change_stations[change_stations != fix_station]
             change_heights = change_heights[change_heights != fix_height]
-            rows = []
-            stations = grouped_by_line.station
+            # the stations are coded in order of unique, so the fix_station is 0
+            station_codes, _ = pd.factorize(grouped_by_line.station)
             data_file = grouped_by_line.iloc[0].data_file
             created_date = grouped_by_line.iloc[0].created
             operator = grouped_by_line.iloc[0].operator
-            for station in stations:
-                row = []
-                for change_station in change_stations:
-                    if station == change_station:
-                        row.append(1)
-                    else:
-                        row.append(0)
-                rows.append(row)
-            grav_design = np.array(rows)
-            design = np.concatenate((grav_design, drift_design), axis=1)
-            # model = sm.WLS(grav, design)
-            # model = sm.WLS(grav, design, weights=1/grouped_by_line.std_err)
-            model = sm.RLM(grav, design)
-            result = model.fit()
-            const = result.params[-1]
-            std_const = result.bse[-1]
-            drift = tuple(result.params[-(max_degree+1):-1])
-            std_drift = tuple(result.bse[-(max_degree+1):-1])
-            gravity = result.params[:-(max_degree+1)]
-            std_gravity = result.bse[:-(max_degree+1)]
-            stations_number = len(change_stations)
-            for index, station, height in zip(range(stations_number), change_stations, change_heights):
-                ties_dict['meter'].append(meter)
-                ties_dict['survey'].append(survey)
-                ties_dict['line'].append(line)
-                ties_dict['from_point'].append(fix_station)
-                ties_dict['to_point'].append(station)
-                ties_dict['from_height'].append(fix_height)
-                ties_dict['to_height'].append(height)
-                ties_dict['gravity'].append(gravity[index])
-                ties_dict['std_gravity'].append(std_gravity[index])
-                ties_dict['drift'].append(drift)
-                ties_dict['std_drift'].append(std_drift)
-                ties_dict['const'].append(const)
-                ties_dict['std_const'].append(std_const)
-                ties_dict['data_file'].append(data_file)
-                ties_dict['created_date'].append(created_date)
-                ties_dict['operator'].append(operator)
-    
-    ties = pd.DataFrame(ties_dict)
+            design = station_design(station_codes, np.arange(1, len(change_stations) + 1), drift_design)
+            lines.append((meter, survey, line, fix_station, fix_height, change_stations, change_heights, data_file, created_date, operator))
+            design_matrices.append(design)
+            observations.append(grav)
 
-    vg = pd.DataFrame()
+    if criterion is not None:
+        _, criteria = nested_lstsq(design_matrices, observations, None, max_degree + 1)
+        terms = best_terms(criteria, criterion, len(design_matrices), max_degree + 1)
+        design_matrices = [
+            design[:, :design.shape[1] - max_degree - 1 + line_terms] for design, line_terms in zip(design_matrices, terms)
+        ]
+
+    fits = rlm_fits(design_matrices, observations, backend)
+
+    for (meter, survey, line, fix_station, fix_height, change_stations, change_heights, data_file, created_date, operator), (params, bse, _, _) in zip(lines, fits):
+        stations_number = len(change_stations)
+        gravity = params[:stations_number]
+        std_gravity = bse[:stations_number]
+        # the drift is from the highest power to the constant
+        drift_params = np.asarray(params[stations_number:])
+        drift_bse = np.asarray(bse[stations_number:])
+        if criterion is not None:
+            drift_params, drift_bse = drift_params[::-1], drift_bse[::-1]
+        const = drift_params[-1]
+        std_const = drift_bse[-1]
+        drift = tuple(drift_params[:-1])
+        std_drift = tuple(drift_bse[:-1])
+        for index, station, height in zip(range(stations_number), change_stations, change_heights):
+            ties_dict['meter'].append(meter)
+            ties_dict['survey'].append(survey)
+            ties_dict['line'].append(line)
+            ties_dict['from_point'].append(fix_station)
+            ties_dict['to_point'].append(station)
+            ties_dict['from_height'].append(fix_height)
+            ties_dict['to_height'].append(height)
+            ties_dict['gravity'].append(gravity[index])
+            ties_dict['std_gravity'].append(std_gravity[index])
+            ties_dict['drift'].append(drift)
+            ties_dict['std_drift'].append(std_drift)
+            ties_dict['const'].append(const)
+            ties_dict['std_const'].append(std_const)
+            ties_dict['data_file'].append(data_file)
+            ties_dict['created_date'].append(created_date)
+            ties_dict['operator'].append(operator)
+
+    return pd.DataFrame(ties_dict)
+
+def get_vg(readings, max_degree=2, vg_max_degree=2, backend='numpy', criterion=None):
+
+    ties = line_ties(readings, max_degree, backend, criterion)
+
+    surveys = []
+    design_matrices = []
+    observations = []
 
     group_by_survey = ties.groupby('survey')
     for survey, grouped_by_survey in group_by_survey:
@@ -97,106 +149,36 @@ def get_vg(readings, max_degree=2, vg_max_degree=2):
         grouped_by_survey['line_meter'] = grouped_by_survey.apply(lambda x: '{line}_{meter}'.format(line=x.line, meter=x.meter), axis=1)
         grav_design = np.repeat(np.matrix(pd.get_dummies(grouped_by_survey.line_meter).astype(float)), 2, axis=0)
         design = np.concatenate((coef_design, grav_design), axis=1)
-        # model = sm.OLS(gravity, design)
-        model = sm.RLM(gravity, design)
-        result = model.fit() 
-        coefs = list(result.params[:vg_max_degree])[::-1]
-        std_coefs = list(result.bse[:vg_max_degree])[::-1]
-        cov_coefs = result.cov_params()[0][1]
+        surveys.append(survey)
+        design_matrices.append(np.asarray(design))
+        observations.append(gravity)
+
+    vg = pd.DataFrame()
+
+    # model = sm.OLS(gravity, design)
+    fits = rlm_fits(design_matrices, observations, backend)
+    for survey, (params, bse, cov, resid) in zip(surveys, fits):
+        coefs = list(params[:vg_max_degree])[::-1]
+        std_coefs = list(bse[:vg_max_degree])[::-1]
+        cov_coefs = cov[0][1]
         coefs_number = len(coefs)
         coef_names = list(map(chr, range(97, 97+coefs_number)))
         std_coef_names = ['u'+x for x in coef_names]
         columns = ['survey']+coef_names+std_coef_names+['covab', 'resid']
-        resid = result.resid
         vg = pd.concat([vg, pd.DataFrame([[survey]+coefs+std_coefs+[cov_coefs]+[resid]], columns=columns)], axis=0)
 
     return ties, vg
 
-def get_vg_by_meter(readings, max_degree=2, vg_max_degree=2):
+def get_vg_by_meter(readings, max_degree=2, vg_max_degree=2, backend='numpy', criterion=None):
 
-    ties_dict = {
-        'meter': [],
-        'survey': [],
-        'line': [],
-        'from_point': [],
-        'to_point': [],
-        'from_height': [],
-        'to_height': [],
-        'gravity': [],
-        'std_gravity': [],
-        'drift': [],
-        'std_drift': [],
-        'const': [],
-        'std_const': [],
-        'data_file': [],
-        'created_date': [],
-        'operator': [],
-   }
+    ties = line_ties(readings, max_degree, backend, criterion)
 
-    group_by_meter_and_survey = readings.groupby(['instrument_serial_number', 'survey_name'])
-    for meter_survey, grouped_by_meter_and_survey in group_by_meter_and_survey:
-        meter, survey = meter_survey
-        group_by_line = grouped_by_meter_and_survey.groupby('line')
-        for line, grouped_by_line in group_by_line:
-            grav = np.vstack(grouped_by_line.corr_grav)
-            date_time = np.array(grouped_by_line.date_time.apply(lambda x: x.timestamp()/86400))
-            drift_design = np.vander(date_time, max_degree + 1)
-            change_stations = grouped_by_line.station.unique()
-            change_heights = grouped_by_line.instr_height.unique()
-            fix_station = change_stations[0]
-            fix_height = change_heights[0]
-            change_stations = change_stations[change_stations != fix_station]
-            change_heights = change_heights[change_heights != fix_height]
-            rows = []
-            stations = grouped_by_line.station
-            data_file = grouped_by_line.iloc[0].data_file
-            created_date = grouped_by_line.iloc[0].created
-            operator = grouped_by_line.iloc[0].operator
-            for station in stations:
-                row = []
-                for change_station in change_stations:
-                    if station == change_station:
-                        row.append(1)
-                    else:
-                        row.append(0)
-                rows.append(row)
-            grav_design = np.array(rows)
-            design = np.concatenate((grav_design, drift_design), axis=1)
-            # model = sm.OLS(grav, design)
-            model = sm.RLM(grav, design)
-            result = model.fit()
-            const = result.params[-1]
-            std_const = result.bse[-1]
-            drift = tuple(result.params[-(max_degree+1):-1])
-            std_drift = tuple(result.bse[-(max_degree+1):-1])
-            gravity = result.params[:-(max_degree+1)]
-            std_gravity = result.bse[:-(max_degree+1)]
-            stations_number = len(change_stations)
-            for index, station, height in zip(range(stations_number), change_stations, change_heights):
-                ties_dict['meter'].append(meter)
-                ties_dict['survey'].append(survey)
-                ties_dict['line'].append(line)
-                ties_dict['from_point'].append(fix_station)
-                ties_dict['to_point'].append(station)
-                ties_dict['from_height'].append(fix_height)
-                ties_dict['to_height'].append(height)
-                ties_dict['gravity'].append(gravity[index])
-                ties_dict['std_gravity'].append(std_gravity[index])
-                ties_dict['drift'].append(drift)
-                ties_dict['std_drift'].append(std_drift)
-                ties_dict['const'].append(const)
-                ties_dict['std_const'].append(std_const)
-                ties_dict['data_file'].append(data_file)
-                ties_dict['created_date'].append(created_date)
-                ties_dict['operator'].append(operator)
-    
-    ties = pd.DataFrame(ties_dict)
-
-    vg = pd.DataFrame()
+    meters_surveys = []
+    design_matrices = []
+    observations = []
 
     group_by_meter_and_survey = ties.groupby(['meter', 'survey'])
     for meter_survey, grouped_by_meter in group_by_meter_and_survey:
-        meter, survey = meter_survey
         from_height = np.vstack(grouped_by_meter.from_height * 1e-3)
         to_height = np.vstack(grouped_by_meter.to_height * 1e-3)
         heights = np.hstack((from_height, to_height)).flatten()
@@ -206,18 +188,22 @@ def get_vg_by_meter(readings, max_degree=2, vg_max_degree=2):
         coef_design = np.vander(heights, vg_max_degree + 1)[:,:-1]
         grav_design = np.repeat(np.matrix(pd.get_dummies(grouped_by_meter.line).astype(float)), 2, axis=0)
         design = np.concatenate((coef_design, grav_design), axis=1)
-        # model = sm.OLS(gravity, design)
-        model = sm.RLM(gravity, design)
-        result = model.fit() 
-        coefs = list(result.params[:vg_max_degree])[::-1]
-        std_coefs = list(result.bse[:vg_max_degree])[::-1]
-        cov_coefs = result.cov_params()[0][1]
+        meters_surveys.append(meter_survey)
+        design_matrices.append(np.asarray(design))
+        observations.append(gravity)
+
+    vg = pd.DataFrame()
+
+    # model = sm.OLS(gravity, design)
+    fits = rlm_fits(design_matrices, observations, backend)
+    for (meter, survey), (params, bse, cov, resid) in zip(meters_surveys, fits):
+        coefs = list(params[:vg_max_degree])[::-1]
+        std_coefs = list(bse[:vg_max_degree])[::-1]
+        cov_coefs = cov[0][1]
         coefs_number = len(coefs)
         coef_names = list(map(chr, range(97, 97+coefs_number)))
         std_coef_names = ['u'+x for x in coef_names]
         columns = ['meter', 'survey']+coef_names+std_coef_names+['covab', 'resid']
-        resid = result.resid
         vg = pd.concat([vg, pd.DataFrame([[meter, survey]+coefs+std_coefs+[cov_coefs]+[resid]], columns=columns)], axis=0)
 
     return ties, vg
-
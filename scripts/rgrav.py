@@ -4,10 +4,13 @@ Read CG-6 data file and calculate ties
 '''
 
 from tkinter import filedialog as fd
+from grav_proc.adjustment import network_adjustment
 from grav_proc.arguments import cli_rgrav_arguments, gui_rgrav_arguments
-from grav_proc.calculations import make_frame_to_proc, \
-    fit_by_meter_created
-from grav_proc.loader import read_data, read_scale_factors
+from grav_proc.calculations import COLUMNS_TO_PROC, make_frame_to_proc, \
+    fit_by_meter_created, apply_scale_factors, drift_degrees
+from grav_proc.cache import DEFAULT_CACHE_DIR
+from grav_proc.incremental import session_states
+from grav_proc.loader import open_data_files, read_data, read_scale_factors
 from grav_proc.plots import residuals_plot, get_map
 from grav_proc.reports import get_report #, make_vgfit_input
 
@@ -25,26 +28,29 @@ def main():
                 calibration_files.append(open(calibration_file_name, 'r', encoding='utf-8'))
             args.scale_factors = calibration_files
 
-    data_files = []
-    for data_file_name in args.input:
-        data_files.append(open(data_file_name, 'r', encoding='utf-8'))
-    args.input = data_files
+    args.input = open_data_files(args.input)
 
-    raw_data = make_frame_to_proc(read_data(args.input))
+    cache_dir = None if args.no_cache else DEFAULT_CACHE_DIR
+
+    where = {
+        'lines': args.lines,
+        'stations': args.stations,
+        'meters': args.meters,
+        'time_range': args.time_range,
+    }
+
+    raw_data = make_frame_to_proc(
+        read_data(
+            args.input,
+            jobs=args.jobs,
+            cache_dir=cache_dir,
+            columns=COLUMNS_TO_PROC,
+            where=where
+        )
+    )
 
     if args.scale_factors:
-        scale_factors = read_scale_factors(args.scale_factors)
-        group_by_meter = scale_factors.groupby('instrument_serial_number')
-        for meter, meter_scale_factors in group_by_meter:
-            scale_factors = list(meter_scale_factors['scale_factor'])
-            scale_factors_std = list(meter_scale_factors['scale_factor'])
-            if len(scale_factors) > 1:
-                print('Warning: There is more than one scale factor for a current gravity meter!')
-            scale_factor = scale_factors[0]
-            scale_factor_std = scale_factors_std[0]
-            raw_data.loc[raw_data['instrument_serial_number'] == meter, 'scale_factor'] = scale_factor
-            raw_data.loc[raw_data['instrument_serial_number'] == meter, 'scale_factor_std'] = scale_factor_std
-            raw_data.loc[raw_data['instrument_serial_number'] == meter, 'corr_grav'] = raw_data.loc[raw_data['instrument_serial_number'] == meter, 'corr_grav'] * scale_factor
+        apply_scale_factors(raw_data, read_scale_factors(args.scale_factors))
     
     by_lines = False
     if args.by_lines:
@@ -58,7 +64,39 @@ def main():
     if args.anchor:
         anchor = args.anchor
 
-    ties = fit_by_meter_created(raw_data, anchor=anchor, method=method, by_lines=by_lines)
+    if args.network:
+        ties, network_scale_factors = network_adjustment(
+            raw_data,
+            anchor=anchor,
+            max_degree=args.max_degree,
+            scale_factors=args.fit_scale_factors,
+            by_lines=by_lines
+        )
+        if args.verbose and args.fit_scale_factors:
+            print(network_scale_factors.to_string(index=False))
+    elif args.state_dir:
+        if method != 'WLS' or args.drift_criterion:
+            print('WARNING: the states of sessions are fitted by WLS with max_degree terms of drift')
+        ties = session_states(
+            raw_data,
+            args.state_dir,
+            anchor=anchor,
+            by_lines=by_lines,
+            max_degree=args.max_degree
+        )
+    else:
+        ties = fit_by_meter_created(
+            raw_data,
+            anchor=anchor,
+            method=method,
+            by_lines=by_lines,
+            jobs=args.jobs,
+            cache_dir=cache_dir,
+            max_degree=args.max_degree,
+            criterion=args.drift_criterion
+        )
+        if args.verbose and args.drift_criterion:
+            print(drift_degrees(raw_data, args.max_degree, by_lines).to_string(index=False))
 
     basename = '-'.join(str(survey) for survey in raw_data.station.unique())
 
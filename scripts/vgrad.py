@@ -8,8 +8,9 @@ from matplotlib import pyplot as plt
 import pandas as pd
 from grav_proc.vertical_gradient import get_vg
 from grav_proc.arguments import cli_vgrad_arguments, gui_vgrad_arguments
-from grav_proc.loader import read_data
-from grav_proc.calculations import make_frame_to_proc
+from grav_proc.cache import DEFAULT_CACHE_DIR
+from grav_proc.loader import open_data_files, read_data, read_scale_factors
+from grav_proc.calculations import COLUMNS_TO_PROC, make_frame_to_proc, apply_scale_factors
 from grav_proc.plots import vg_plot
 from grav_proc.reports import make_vg_ties_report, make_vg_coeffs_report
 
@@ -25,14 +26,31 @@ def main():
                 calibration_files.append(open(calibration_file_name, 'r', encoding='utf-8'))
             args.scale_factors = calibration_files
 
-    data_files = []
-    for data_file_name in args.input:
-        data_files.append(open(data_file_name, 'r', encoding='utf-8'))
-    args.input = data_files
+    args.input = open_data_files(args.input)
+
+    cache_dir = None if args.no_cache else DEFAULT_CACHE_DIR
     
-    raw_data = make_frame_to_proc(read_data(args.input))
+    where = {
+        'lines': args.lines,
+        'stations': args.stations,
+        'meters': args.meters,
+        'time_range': args.time_range,
+    }
+
+    raw_data = make_frame_to_proc(
+        read_data(
+            args.input,
+            jobs=args.jobs,
+            cache_dir=cache_dir,
+            columns=COLUMNS_TO_PROC,
+            where=where
+        )
+    )
+
+    if args.scale_factors:
+        apply_scale_factors(raw_data, read_scale_factors(args.scale_factors))
 
-    vg_ties, vg_coef = get_vg(raw_data)
+    vg_ties, vg_coef = get_vg(raw_data, criterion=args.drift_criterion)
 
     if args.coeffs:
         output_coeffs = args.coeffs.name
@@ -0,0 +1,111 @@
+'''
+Benchmark of sending the groups of fit_by_meter_created to worker processes:
+pickled frame slices and numpy payloads versus the shared memory columns
+
+python tests/benchmark_transport.py --rows 2000000 --groups 5000 --jobs 4
+'''
+
+import argparse
+import pickle
+from time import perf_counter
+import numpy as np
+import pandas as pd
+from grav_proc.calculations import fit_by_meter_created, group_payloads
+from grav_proc.fit_cache import FIT_CACHE
+from grav_proc.shared import share_columns
+
+
+def synthetic_readings(rows, groups, stations=200, seed=0):
+    ''' Frame of make_frame_to_proc columns with random readings of groups '''
+    rng = np.random.default_rng(seed)
+    group = np.sort(rng.integers(0, groups, rows))
+    station_gravity = rng.normal(0, 5e4, stations)
+    station = rng.integers(0, stations, rows)
+    date_days = 19000 + group + np.arange(rows) % 1000 / 1440
+    return pd.DataFrame(
+        {
+            'instrument_serial_number': group % 5,
+            'created': pd.to_datetime(group, unit='D', origin='2020-01-01'),
+            'survey_name': 'survey',
+            'operator': 'operator',
+            'meter_type': 'CG6',
+            'station': pd.Series(station).astype(str),
+            'corr_grav': station_gravity[station] + 5e6 + 100 * (date_days - 19000) + rng.normal(0, 5, rows),
+            'std_err': np.full(rows, 5.0),
+            'date_days': date_days,
+            'lat': 43.0,
+            'lon': 77.0,
+            'instr_height': 200.0,
+        }
+    )
+
+
+def timed(function, *args):
+    start = perf_counter()
+    result = function(*args)
+    return result, perf_counter() - start
+
+
+def pickle_round_trip(chunks):
+    ''' Pickle and unpickle the chunks as the process pool does, returns bytes '''
+    size = 0
+    for chunk in chunks:
+        data = pickle.dumps(chunk, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.loads(data)
+        size += len(data)
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--groups', type=int, default=2000)
+    parser.add_argument('--jobs', type=int, default=4)
+    args = parser.parse_args()
+
+    raw_data = synthetic_readings(args.rows, args.groups)
+    groupby = raw_data.groupby(['instrument_serial_number', 'created'], observed=True)
+    positions = list(groupby.indices.values())
+    chunks = np.array_split(np.arange(len(positions)), args.jobs)
+
+    codes, _ = pd.factorize(raw_data.station, sort=True)
+    order = np.concatenate(positions)
+    counts = np.array([len(group_positions) for group_positions in positions])
+    groups = list(zip((np.cumsum(counts) - counts).tolist(), counts.tolist(), codes[order[np.cumsum(counts) - counts]].tolist()))
+    columns = {
+        'codes': codes[order],
+        'gravity': raw_data.corr_grav.to_numpy(dtype=float)[order],
+        'date_days': raw_data.date_days.to_numpy(dtype=float)[order],
+        'weights': 1 / raw_data.std_err.to_numpy(dtype=float)[order],
+        'resid': np.full(len(order), np.nan),
+    }
+
+    frame_chunks = [[raw_data.iloc[positions[index]] for index in chunk] for chunk in chunks]
+    payloads = group_payloads(columns, groups)
+    payload_chunks = [[payloads[index] for index in chunk] for chunk in chunks]
+
+    results = []
+    size, seconds = timed(pickle_round_trip, frame_chunks)
+    results.append(('pickled frame slices', size, seconds))
+    size, seconds = timed(pickle_round_trip, payload_chunks)
+    results.append(('pickled numpy payloads', size, seconds))
+    (block, layout), share_seconds = timed(share_columns, columns)
+    try:
+        size, seconds = timed(pickle_round_trip, [(layout, [groups[index] for index in chunk]) for chunk in chunks])
+        results.append(('shared memory layout', size, seconds + share_seconds))
+    finally:
+        block.close()
+        block.unlink()
+
+    print(f'{args.rows} readings, {len(positions)} groups, {args.jobs} chunks')
+    print(pd.DataFrame(results, columns=['transport', 'bytes', 'seconds']).to_string(index=False))
+
+    for jobs in (1, args.jobs):
+        # the fits of the first run are not reused
+        FIT_CACHE.clear()
+        _, seconds = timed(fit_by_meter_created, raw_data.copy(), None, 'WLS', False, 'numpy', jobs)
+        print(f'fit_by_meter_created jobs={jobs}: {seconds:.2f} s')
+
+
+if __name__ == '__main__':
+    main()
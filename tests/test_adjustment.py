@@ -0,0 +1,53 @@
+'''
+Network adjustment of the example readings
+
+python -m pytest tests/test_adjustment.py
+'''
+
+import glob
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from grav_proc.adjustment import network_adjustment
+from grav_proc.calculations import COLUMNS_TO_PROC, fit_by_meter_created, make_frame_to_proc
+from grav_proc.loader import read_data
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(__file__), '..', 'examples')
+
+
+def example_frame(name):
+    ''' Processing frame of the example data files '''
+    data_files = sorted(glob.glob(os.path.join(EXAMPLES_DIR, name, '*.dat')))
+    return make_frame_to_proc(read_data(data_files, columns=COLUMNS_TO_PROC))
+
+
+def test_network_adjustment_skips_readings_without_session():
+    raw_data = example_frame('diff_grav')
+    # the readings of the last station of the first session have no operator
+    first_session = raw_data.created == raw_data.created.iloc[0]
+    missing = first_session & (raw_data.station == raw_data.station[first_session].iloc[-1])
+    assert missing.any()
+    raw_data['operator'] = raw_data.operator.where(~missing)
+    complete_data = raw_data[~missing].copy()
+
+    ties, scales = network_adjustment(raw_data)
+    complete_ties, complete_scales = network_adjustment(complete_data)
+
+    pd.testing.assert_frame_equal(ties, complete_ties)
+    pd.testing.assert_frame_equal(scales, complete_scales)
+    assert raw_data.resid[missing].isna().all()
+    np.testing.assert_array_equal(raw_data.resid[~missing], complete_data.resid)
+
+    # the groups of fit_by_meter_created leave out the same readings
+    pd.testing.assert_frame_equal(
+        fit_by_meter_created(raw_data, anchor=None), fit_by_meter_created(complete_data, anchor=None)
+    )
+
+
+def test_missing_anchor():
+    raw_data = example_frame('diff_grav')
+    with pytest.raises(KeyError, match='nowhere not found in stations'):
+        network_adjustment(raw_data, anchor='nowhere')
+    with pytest.raises(KeyError, match='nowhere not found in stations'):
+        fit_by_meter_created(raw_data, anchor='nowhere')
@@ -0,0 +1,77 @@
+'''
+Incremental fits of the growing sessions against the fits of whole sessions
+
+python -m pytest tests/test_incremental.py
+'''
+
+import glob
+import os
+import numpy as np
+import pandas as pd
+from grav_proc.calculations import (
+    COLUMNS_TO_PROC, fit_by_meter_created, free_grav_fit, make_frame_to_proc, session_order
+)
+from grav_proc.incremental import append_readings, load_state, new_state, save_state, session_states, state_solution
+from grav_proc.loader import read_data
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(__file__), '..', 'examples')
+
+
+def example_frame(name):
+    ''' Processing frame of the example data files '''
+    data_files = sorted(glob.glob(os.path.join(EXAMPLES_DIR, name, '*.dat')))
+    return make_frame_to_proc(read_data(data_files, columns=COLUMNS_TO_PROC))
+
+
+def first_session(raw_data):
+    ''' Readings of the first group of fit_by_meter_created '''
+    _, _, counts, offsets, order = session_order(raw_data)
+    return raw_data.iloc[order[offsets[0]:offsets[0] + counts[0]]]
+
+
+def test_append_readings_match_free_grav_fit(tmp_path):
+    session = first_session(example_frame('diff_grav'))
+    state_file = tmp_path / 'state.npz'
+    save_state(new_state(), state_file)
+
+    # the session is read again with more readings every time
+    ends = [len(session) // 3, 2 * len(session) // 3, len(session)]
+    assert not set(session.station.iloc[ends[0]:]) <= set(session.station.iloc[:ends[0]])
+    for end in ends:
+        state = append_readings(load_state(state_file), session.iloc[:end])
+        save_state(state, state_file)
+
+    ties, _, _ = state_solution(load_state(state_file))
+    fitgrav, _ = free_grav_fit(
+        stations=session.station,
+        gravity=session.corr_grav,
+        date_time=session.date_days,
+        fix_station=session.station.iloc[0],
+        std=session.std_err,
+    )
+
+    assert len(ties) == len(fitgrav)
+    np.testing.assert_array_equal(ties.station_from, fitgrav.station_from)
+    np.testing.assert_array_equal(ties.station_to, fitgrav.station_to)
+    np.testing.assert_allclose(ties.tie, fitgrav.tie, rtol=1e-9, atol=1e-7)
+    np.testing.assert_allclose(ties.err, fitgrav.err, rtol=1e-6, atol=1e-9)
+
+
+def test_session_states_match_fit_by_meter_created(tmp_path):
+    raw_data = example_frame('diff_grav')
+    keys, _, counts, _, _ = session_order(raw_data)
+    partial_data = raw_data[raw_data.groupby(keys, observed=True).cumcount() < 30].copy()
+
+    session_states(partial_data, tmp_path)
+    ties = session_states(raw_data, tmp_path)
+    states = [load_state(state_file) for state_file in tmp_path.glob('*.npz')]
+    assert sorted(state['readings'] for state in states) == sorted(counts)
+    resid = raw_data.resid.copy()
+    fit_ties = fit_by_meter_created(raw_data, anchor=None)
+
+    pd.testing.assert_frame_equal(
+        ties.drop(columns=['tie', 'err']), fit_ties.drop(columns=['tie', 'err'])
+    )
+    np.testing.assert_allclose(ties.tie, fit_ties.tie, rtol=1e-9, atol=1e-7)
+    np.testing.assert_allclose(ties.err, fit_ties.err, rtol=1e-6, atol=1e-9)
+    np.testing.assert_allclose(resid, raw_data.resid, atol=1e-7)
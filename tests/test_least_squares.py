@@ -0,0 +1,132 @@
+'''
+Parity of the batched solvers with statsmodels on the example sessions
+
+python -m pytest tests/test_least_squares.py
+'''
+
+import glob
+import os
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+import statsmodels.api as sm
+from grav_proc.calculations import (
+    COLUMNS_TO_PROC, group_payloads, make_frame_to_proc, payload_designs, session_columns, session_order
+)
+from grav_proc.least_squares import lstsq_fits, robust_fits
+from grav_proc.loader import read_data
+import grav_proc.vertical_gradient as vertical_gradient
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(__file__), '..', 'examples')
+
+# the example sessions of fit_by_meter_created
+SESSIONS = ['diff_grav', 'shu']
+
+
+def example_frame(name):
+    ''' Processing frame of the example data files '''
+    data_files = sorted(glob.glob(os.path.join(EXAMPLES_DIR, name, '*.dat')))
+    raw_data, _ = make_frame_to_proc(read_data(data_files, columns=COLUMNS_TO_PROC), spread=True)
+    return raw_data
+
+
+def session_problems(name):
+    ''' Design matrices, observations and weights of the groups of fit_by_meter_created '''
+    raw_data = example_frame(name)
+    _, _, counts, offsets, order = session_order(raw_data)
+    codes, _ = pd.factorize(raw_data.station, sort=True)
+    groups = zip(offsets.tolist(), counts.tolist(), codes[order[offsets]].tolist())
+    design_matrices, observations, weights, _ = payload_designs(
+        group_payloads(session_columns(raw_data, codes, order), groups)
+    )
+    return design_matrices, observations, weights
+
+
+def line_problems():
+    ''' Design matrices and observations of the line fits of get_vg '''
+    problems = []
+
+    def capture(design_matrices, observations, backend='numpy'):
+        problems.extend(zip(design_matrices, observations))
+        return original(design_matrices, observations, backend)
+
+    original = vertical_gradient.rlm_fits
+    vertical_gradient.rlm_fits = capture
+    try:
+        vertical_gradient.line_ties(example_frame('vertical_gradient'))
+    finally:
+        vertical_gradient.rlm_fits = original
+
+    return [design for design, _ in problems], [observation for _, observation in problems]
+
+
+def statsmodels_rlm(observation, design_matrix):
+    ''' sm.RLM fit with the default options, its rank deficiency warning is silenced '''
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return sm.RLM(observation, design_matrix).fit()
+
+
+@pytest.mark.parametrize('name', SESSIONS)
+def test_lstsq_fits_match_wls(name):
+    design_matrices, observations, weights = session_problems(name)
+    solutions = lstsq_fits(design_matrices, observations, weights)
+
+    for design_matrix, observation, fit_weights, (params, cov, resid) in zip(design_matrices, observations, weights, solutions):
+        result = sm.WLS(observation, design_matrix.toarray(), weights=fit_weights).fit()
+        np.testing.assert_allclose(params, result.params, rtol=1e-9, atol=1e-7)
+        np.testing.assert_allclose(cov, result.cov_params(), rtol=1e-6, atol=1e-12)
+        np.testing.assert_allclose(resid, result.resid, atol=1e-7)
+
+
+@pytest.mark.parametrize('name', SESSIONS)
+def test_robust_fits_match_rlm(name):
+    design_matrices, observations, _ = session_problems(name)
+    solutions, diagnostics = robust_fits(design_matrices, observations)
+
+    assert len(diagnostics) == len(design_matrices)
+    assert diagnostics.iterations.between(1, 50).all()
+    assert (diagnostics.iterations[~diagnostics.converged] == 50).all()
+    for design_matrix, observation, (params, cov, resid) in zip(design_matrices, observations, solutions):
+        result = statsmodels_rlm(observation, design_matrix.toarray())
+        np.testing.assert_allclose(params, result.params, rtol=1e-9, atol=1e-6)
+        np.testing.assert_allclose(np.sqrt(np.diagonal(cov)), result.bse, rtol=1e-6, atol=1e-7)
+        np.testing.assert_allclose(resid, result.resid, atol=1e-6)
+
+
+def test_robust_fits_match_rlm_rank_deficient():
+    design_matrices, observations = line_problems()
+    assert all(np.linalg.matrix_rank(design.toarray()) < design.shape[1] for design in design_matrices)
+    # the WLS fits of rank deficient problems are left to statsmodels
+    assert all(solution is None for solution in lstsq_fits(design_matrices, observations))
+
+    solutions, diagnostics = robust_fits(design_matrices, observations)
+    assert diagnostics.converged.all()
+    for design_matrix, observation, (params, cov, resid) in zip(design_matrices, observations, solutions):
+        result = statsmodels_rlm(observation, design_matrix.toarray())
+        # statsmodels does not converge on these designs, so the parity is
+        # up to a small fraction of the errors and of the scale
+        np.testing.assert_array_less(np.abs(params - result.params), 2e-3 * result.bse)
+        np.testing.assert_allclose(np.sqrt(np.diagonal(cov)), result.bse, rtol=1e-3)
+        np.testing.assert_array_less(np.abs(resid - result.resid), 2e-3 * result.scale)
+
+
+def test_robust_fits_iterations():
+    rng = np.random.default_rng(0)
+    design_matrices, observations = [], []
+    for _ in range(20):
+        design_matrix = np.column_stack((rng.integers(0, 2, 40), np.linspace(0, 1, 40), np.ones(40)))
+        observation = design_matrix @ rng.normal(0, 10, 3) + rng.normal(0, 1, 40)
+        observation[rng.integers(0, 40, 3)] += rng.normal(0, 20, 3)
+        design_matrices.append(design_matrix)
+        observations.append(observation)
+
+    _, diagnostics = robust_fits(design_matrices, observations)
+    iterations = [statsmodels_rlm(observation, design_matrix).fit_history['iteration'] for design_matrix, observation in zip(design_matrices, observations)]
+    assert diagnostics.converged.all()
+    np.testing.assert_array_equal(diagnostics.iterations, iterations)
+
+    _, diagnostics = robust_fits(design_matrices, observations, max_iterations=2)
+    assert not diagnostics.converged.all()
+    assert (diagnostics.iterations[~diagnostics.converged] == 2).all()